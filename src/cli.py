@@ -13,11 +13,43 @@ def get_options():
     parser.add_argument('target', help='target image path')
     parser.add_argument('--resize', type=int, default=128,
         help='resize target image smaller while keeping aspect ratio [default: %(default)s]')
+    parser.add_argument('--prescreen-levels', type=int, default=0,
+        help='evaluate mutants first on the target halved this many times (0 = disabled) [default: %(default)s]')
+    parser.add_argument('--prescreen-margin', type=float, default=0.0,
+        help='relative worsening tolerated on the prescreen levels [default: %(default)s]')
+    parser.add_argument('--incremental', default=False, action='store_true',
+        help='evaluate mutants only in the region of the changed shapes [default: %(default)s]')
+    parser.add_argument('--sample-fraction', type=float, default=0.0,
+        help='estimate mutants evaluation on this fraction of pixels first (0 = disabled) [default: %(default)s]')
+    parser.add_argument('--sample-sets', type=int, default=4,
+        help='number of pixel samples used in turn (1 = fixed sample) [default: %(default)s]')
+    parser.add_argument('--layer-cache', type=int, default=0,
+        help='snapshot the canvas of each island best every this many painted shapes, '
+             'to re-render mutants from their first changed shape (0 = disabled) [default: %(default)s]')
+    parser.add_argument('--n-mutants', type=int, default=1,
+        help='children generated from each island best at every step and evaluated as a batch, '
+             'the best improving one replacing it (1 + lambda) [default: %(default)s]')
+    parser.add_argument('--rejection-cache', type=int, default=4096,
+        help='size of the LRU cache of the mutations rejected by each island best, '
+             'skipped if drawn again (0 = disabled) [default: %(default)s]')
+    parser.add_argument('--packed', default=False, action='store_true',
+        help='keep the genomes packed as bits, 8 bases per byte [default: %(default)s]')
+    parser.add_argument('--cache-size', type=int, default=0,
+        help='size of the LRU evaluations cache of each island and of the crossover '
+             '(0 = disabled) [default: %(default)s]')
     parser.add_argument('-n', '--n-shapes', type=int, default=64,
         help='number of shapes to use [default: %(default)s]')
     parser.add_argument('-s', '--shape', default='t',
         help='shapes used to draw: t=triangle, q=quad, r=rect, c=circle, e=ellipse, l=line [default: %(default)s]')
+    parser.add_argument('--renderer', default='pil', choices=['pil', 'numpy'],
+        help='shapes rendering backend [default: %(default)s]')
+    parser.add_argument('--canvas-pool', type=int, default=0,
+        help='number of discarded images kept to be drawn again, instead of allocating new ones '
+             '(0 = disabled) [default: %(default)s]')
     parser.add_argument('--symmetry', default='', help='Symmetry elements [default: %(default)s]')
+    parser.add_argument('--mirror', default=False, action='store_true',
+        help='draw the symmetry mirroring the pixels of the fundamental domain instead of duplicating the shapes, '
+             'and evaluate only that domain [default: %(default)s]')
     parser.add_argument('-i', '--n-islands', type=int, default=2,
         help='number of islands [default: %(default)s]')
     parser.add_argument('-c', '--crossover-freq', type=int, default=1000,
@@ -36,6 +68,12 @@ def get_options():
         help='enable single position probability mutations (experimental)')
     parser.add_argument('--restart', default=False, action='store_true',
         help='do not resume existing history, but *erase* it and restart [default=%(default)s]')
+    parser.add_argument('--persistent-workers', default=False, action='store_true',
+        help='keep each island resident in a long-lived worker process, exchanging only '
+             'the compact results of its runs [default=%(default)s]')
+    parser.add_argument('--shared-target', default=False, action='store_true',
+        help='place the target arrays in shared memory, attached by name by the worker processes '
+             'instead of being sent to them [default=%(default)s]')
     parser.add_argument('-p', '--processes', type=int, default=0,
         help='number of processes in which islands runs are distributed (0 = auto) [default=%(default)s]')
 
@@ -0,0 +1,14 @@
+import random
+
+import numpy as np
+import pytest
+from PIL import Image
+
+
+@pytest.fixture
+def target(tmp_path):
+    random.seed(0)
+    rng = np.random.RandomState(0)
+    path = str(tmp_path / 'target.png')
+    Image.fromarray(rng.randint(0, 256, (24, 32, 3)).astype(np.uint8)).save(path)
+    return path
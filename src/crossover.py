@@ -5,6 +5,8 @@ Crossing over functions.
 from random import normalvariate
 from random import sample
 
+import numpy as np
+
 
 def crossover(seq1, seq2, points=()):
     """
@@ -38,6 +40,8 @@ def crossover(seq1, seq2, points=()):
     >>> ''.join(r2)
     'conFETTO'
     """
+    if isinstance(seq1, np.ndarray):
+        return crossover_arrays(seq1, seq2, points)
     ret1 = list(seq1)
     ret2 = list(seq2)
     end = max(len(seq1), len(seq2))
@@ -52,6 +56,31 @@ def crossover(seq1, seq2, points=()):
     return ret1, ret2
 
 
+def crossover_arrays(arr1, arr2, points=()):
+    """
+    Same as `crossover`, for numpy arrays: the regions are exchanged
+    by slicing and concatenating, instead of base by base.
+
+    >>> r1, r2 = crossover_arrays(np.array(list('ABCDEFGHIJ')), np.array(list('abcdefghi')), (3, 6))
+    >>> ''.join(r1), ''.join(r2)
+    ('ABCdefGHIJ', 'abcDEFghi')
+
+    >>> r1, r2 = crossover_arrays(np.arange(5), np.arange(10, 13), (4, 1))
+    >>> r1.tolist(), r2.tolist()
+    ([0, 1, 2, 3, 4], [10, 11, 12])
+    """
+    end = max(len(arr1), len(arr2))
+    for i in range(0, len(points), 2):
+        start = points[i]
+        stop = points[i + 1] if i + 1 < len(points) else end
+        # As list slice assignment, an empty region (stop < start) is inserted at start
+        arr1, arr2 = (
+            np.concatenate([arr1[:start], arr2[start: stop], arr1[max(start, stop):]]),
+            np.concatenate([arr2[:start], arr1[start: stop], arr2[max(start, stop):]]),
+        )
+    return arr1, arr2
+
+
 def normal_uniform_rand_crossover_operator(seq1, seq2, mu=1, sigma=0.666, min_n_events=1):
     """
     Restituisce una lista di n (numero casuale con distribuzione normale definita da `mu` e `sigma`)
@@ -1,5 +1,7 @@
+from collections import Counter
 from enum import Enum
 
+import numpy as np
 import svgwrite
 from PIL import Image, ImageDraw
 
@@ -24,6 +26,7 @@ POINTS_PER_SHAPE = {
 EXTRA_BITS_PER_SHAPE = {
     Shape.LINE: 4,  # width
 }
+CIRCLE_SIZE = 10
 CHANNELS_TO_IMAGE_MODE = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}
 IMAGE_MODES = list(CHANNELS_TO_IMAGE_MODE.values())
 
@@ -34,22 +37,30 @@ def draw_as_svg(filename,
                 dst_image_mode='RGB',
                 draw_image_mode='RGBA',
                 symmetry='',
+                mirror=False,
                 ):
+    """
+    Save the drawing as svg.
+
+    In `mirror` mode (see `ShapesEncoder`), the `shapes` are drawn once
+    and the drawing is made symmetric as `mirror_image` does.
+    """
     if shape is Shape.ELLIPSE:
         return
 
     width, height = image_size
     dwg = svgwrite.Drawing(filename=filename)
     dwg.viewbox(width=width, height=height)
+    drawing = dwg.g(id='drawing') if mirror else dwg
     color = [v / 255 for v in background_color]
     r, g, b, a = tuple_to_rgba(color)
     background = dwg.polygon(
         points=[(0, 0), (width, 0), (width, height), (0, height)],
         fill='rgb({}%, {}%, {}%)'.format(r * 100, g * 100, b * 100),
     )
-    dwg.add(background)
+    drawing.add(background)
 
-    total_shapes = symmetrify_shapes(image_size, symmetry, shapes)
+    total_shapes = symmetrify_shapes(image_size, '' if mirror else symmetry, shapes)
 
     for color, points, extra in total_shapes:
         color = [v / 255 for v in color]
@@ -62,10 +73,55 @@ def draw_as_svg(filename,
                 points=points,
                 fill='rgb({}%, {}%, {}%)'.format(r * 100, g * 100, b * 100),
                 opacity=a)
-        dwg.add(shape)
+        drawing.add(shape)
+    if mirror:
+        dwg.defs.add(drawing)
+        dwg.add(dwg.use(svg_mirrored(dwg, drawing, image_size, symmetry)))
     dwg.save()
 
 
+def svg_mirrored(dwg, drawing, image_size, symmetry):
+    """
+    Return the svg group of `drawing` made symmetric like `mirror_image`:
+    for each flip, a copy of the fundamental domain (clipped) over its mirror image.
+    """
+    width, height = image_size
+    half_w, half_h = width // 2, height // 2
+    flip_x = 'translate({}, 0) scale(-1, 1)'.format(width)
+    flip_y = 'translate(0, {}) scale(1, -1)'.format(height)
+    rotate = 'translate({}, {}) scale(-1, -1)'.format(width, height)
+    for i, element in enumerate(mirror_elements(symmetry)):
+        # Domain (x, y, width, height) boxes and transforms to their images
+        if element == 'x':
+            copies = [((0, 0, half_w, height), flip_x)]
+        elif element == 'y':
+            copies = [((0, 0, width, half_h), flip_y)]
+        else:
+            copies = [((0, 0, width, half_h), rotate)]
+            if height % 2:
+                copies.append(((0, half_h, half_w, 1), flip_x))
+        group = dwg.g(id='mirror-{}'.format(i))
+        group.add(dwg.use(drawing))
+        for j, ((x, y, box_width, box_height), transform) in enumerate(copies):
+            clip = dwg.defs.add(dwg.clipPath(id='domain-{}-{}'.format(i, j)))
+            clip.add(dwg.rect(insert=(x, y), size=(box_width, box_height)))
+            group.add(dwg.use(drawing, clip_path='url(#{})'.format(clip['id']), transform=transform))
+        dwg.defs.add(group)
+        drawing = group
+    return drawing
+
+
+def as_image(phenotype):
+    """
+    Return `phenotype` as a Pillow image, converting arrays
+    (height, width, channels) drawn by the numpy rasterizer.
+    """
+    if isinstance(phenotype, np.ndarray):
+        mode = CHANNELS_TO_IMAGE_MODE[phenotype.shape[2]]
+        return Image.fromarray(phenotype[:, :, 0] if mode == 'L' else phenotype, mode)
+    return phenotype
+
+
 def tuple_to_rgba(color):
     color_length = len(color)
     if color_length == 4:
@@ -84,34 +140,98 @@ def tuple_to_rgba(color):
     return r, g, b, a
 
 
+class CanvasPool:
+    """
+    Canvases (Pillow images or numpy arrays) of the same size and mode
+    no longer used, to be reused by the renderers instead of allocating
+    new ones.
+
+    Only canvases which are not referenced anymore must be released.
+    """
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.free = []
+        self.scratch = None  # working canvas of the numpy rasterizer
+        # Stats
+        self.n_allocated = self.n_reused = 0
+
+    def __repr__(self):
+        return 'CanvasPool(free={}, allocated={}, reused={})'.format(
+            len(self.free), self.n_allocated, self.n_reused)
+
+    def __getstate__(self):
+        # Do not copy canvases between processes
+        return {'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state['maxsize'])
+
+    def acquire(self, new):
+        """
+        Return a free canvas, or a new one created calling `new()`.
+        """
+        if self.free:
+            self.n_reused += 1
+            return self.free.pop()
+        self.n_allocated += 1
+        return new()
+
+    def release(self, canvas):
+        """
+        Give back a `canvas` to be reused.
+        """
+        if canvas is not None and len(self.free) < self.maxsize:
+            self.free.append(canvas)
+
+
 def draw_shapes(
         image_size, shapes, shape,
         background_color='white',
         dst_image_mode='RGB',
         draw_image_mode='RGBA',
         symmetry='',
+        scale=1,
+        out=None,
     ):
     """
     Create an RGB (by default) image and draw `shapes` on it
     in RGBA mode (with alpha).
+
+    If `scale` is given, the image (and the shapes) are drawn
+    resized by that factor.
+    If `out` is given, that image is filled with the background and drawn on.
     """
-    # TODO: optimize by passing already created image
     # print('image_size =', image_size)
     # print('shapes =', shapes)
     # print('dst_image_mode =', dst_image_mode)
     # print('background_color =', background_color)
     # print('Creating {} image'.format(dst_image_mode))
-    im = Image.new(dst_image_mode, image_size, color=background_color)
+    width, height = image_size
+    if out is None:
+        im = Image.new(dst_image_mode, (int(width * scale), int(height * scale)), color=background_color)
+    else:
+        im = out
+        im.paste(background_color, (0, 0) + im.size)
+    total_shapes = symmetrify_shapes(image_size, symmetry, shapes)
+    return paint_shapes(im, total_shapes, shape, draw_image_mode, scale)
+
+
+def paint_shapes(im, shapes, shape, draw_image_mode='RGBA', scale=1):
+    """
+    Paint `shapes` (color, points, extra), in order, on the image `im`.
+    """
     # print('Drawing in {} mode'.format(draw_image_mode))
     drawer = ImageDraw.Draw(im, draw_image_mode)
+    circle_size = CIRCLE_SIZE * scale
 
-    total_shapes = symmetrify_shapes(image_size, symmetry, shapes)
-
-    for color, points, extra in total_shapes:
+    for color, points, extra in shapes:
+        if scale != 1:
+            points = [(x * scale, y * scale) for (x, y) in points]
+            extra = extra and int(extra * scale)
         if shape is Shape.ELLIPSE:
             drawer.ellipse(points, color)
         elif shape is Shape.CIRCLE:
-            drawer.ellipse((points[0], (points[0][0] + 10, points[0][1] + 10)), color)
+            drawer.ellipse((points[0], (points[0][0] + circle_size, points[0][1] + circle_size)), color)
         elif shape is Shape.LINE:
             drawer.line(points, fill=color, width=extra)
         elif shape is Shape.RECT:
@@ -147,3 +267,105 @@ def get_symmetry(image_size, symmetry_element, points):
     else:
         raise Exception('Invalid symmetry_element value: "{}"'.format(symmetry_element))
     return rv
+
+
+def mirror_elements(symmetry):
+    """
+    Return the pixel flips ('x', 'y' and/or 'o') generating the same group
+    of mirror symmetries as the `symmetry` elements ('.' is ignored).
+    """
+    flips = set(symmetry) - {'.'}
+    for element in flips:
+        if element not in 'xyo':
+            raise Exception('Invalid symmetry_element value: "{}"'.format(element))
+    # Any two of the three flips generate the third one
+    return ('x', 'y') if len(flips) > 1 else tuple(flips)
+
+
+def mirror_pixels(array, symmetry):
+    """
+    Make an `array` of pixels (..., height, width) symmetric, in place,
+    copying its fundamental domain (left, upper or upper-left part)
+    over its mirror images.
+    """
+    height, width = array.shape[-2:]
+    half_w, half_h = width // 2, height // 2
+    for element in mirror_elements(symmetry):
+        if element == 'x':
+            array[..., width - half_w:] = array[..., :half_w][..., ::-1]
+        elif element == 'y':
+            array[..., height - half_h:, :] = array[..., :half_h, :][..., ::-1, :]
+        else:
+            array[..., height - half_h:, :] = array[..., :half_h, :][..., ::-1, ::-1]
+            if height % 2:
+                row = array[..., half_h, :]
+                row[..., width - half_w:] = row[..., :half_w][..., ::-1]
+    return array
+
+
+def mirror_image(im, symmetry):
+    """
+    Same as `mirror_pixels`, but for a Pillow image.
+    """
+    width, height = im.size
+    half_w, half_h = width // 2, height // 2
+    for element in mirror_elements(symmetry):
+        if element == 'x':
+            im.paste(im.crop((0, 0, half_w, height)).transpose(Image.FLIP_LEFT_RIGHT), (width - half_w, 0))
+        elif element == 'y':
+            im.paste(im.crop((0, 0, width, half_h)).transpose(Image.FLIP_TOP_BOTTOM), (0, height - half_h))
+        else:
+            im.paste(im.crop((0, 0, width, half_h)).transpose(Image.ROTATE_180), (0, height - half_h))
+            if height % 2:
+                row = im.crop((0, half_h, half_w, half_h + 1)).transpose(Image.FLIP_LEFT_RIGHT)
+                im.paste(row, (width - half_w, half_h))
+    return im
+
+
+def _shape_key(shape_info):
+    color, points, extra = shape_info
+    return color, tuple(points), extra
+
+
+def changed_shapes(shapes_a, shapes_b):
+    """
+    Return the shapes which are not common to `shapes_a` and `shapes_b`
+    (i.e. their multiset symmetric difference).
+
+    Since the drawing order of the common shapes does not change,
+    pixels outside these shapes are drawn the same in both cases.
+    """
+    counter_a = Counter(map(_shape_key, shapes_a))
+    counter_b = Counter(map(_shape_key, shapes_b))
+    diff = (counter_a - counter_b) + (counter_b - counter_a)
+    return [(color, list(points), extra) for (color, points, extra) in diff.elements()]
+
+
+def shapes_box(image_size, shapes, shape, symmetry=''):
+    """
+    Return the (left, upper, right, lower) box enclosing `shapes`
+    and their symmetric copies, clipped to the image.
+
+    Return None if the box falls outside of the image.
+    """
+    width, height = image_size
+    xs = []
+    ys = []
+    margin = 1
+    for color, points, extra in symmetrify_shapes(image_size, symmetry, shapes):
+        if shape is Shape.CIRCLE:
+            x, y = points[0]
+            points = [(x, y), (x + CIRCLE_SIZE, y + CIRCLE_SIZE)]
+        elif shape is Shape.LINE:
+            margin = max(margin, extra // 2 + 1)
+        xs.extend([x for x, y in points])
+        ys.extend([y for x, y in points])
+    if not xs:
+        return None
+    left = max(0, min(xs) - margin)
+    upper = max(0, min(ys) - margin)
+    right = min(width, max(xs) + 1 + margin)
+    lower = min(height, max(ys) + 1 + margin)
+    if left >= right or upper >= lower:
+        return None
+    return left, upper, right, lower
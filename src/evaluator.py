@@ -1,6 +1,23 @@
+import pickle
+from multiprocessing.reduction import ForkingPickler
+
 import numpy as np
 from PIL import Image
 
+from drawer import mirror_pixels
+from genome import default_rng, genome_bits, genome_digest
+from shared_arrays import attach_arrays, share_arrays, unlink_arrays
+from utils import LRUCache
+
+# Evaluation of candidates discarded before the end of the evaluation,
+# since they cannot be better than a given threshold
+REJECTED = float('inf')
+
+# Constant arrays of ImageEvaluator that can be placed in shared memory (see `ImageEvaluator.share`)
+SHARED_ATTRIBUTES = ('target_arr', 'pyramid', 'samples', 'fold')
+# Buffers and views of ImageEvaluator, created again instead of being pickled (see `ImageEvaluator.create_buffers`)
+BUFFER_ATTRIBUTES = ('target_pixels', 'diff_arr', 'fold_pixels', 'fold_diff')
+
 
 def resized(image, max_size):
     w, h = image.size
@@ -12,8 +29,32 @@ def resized(image, max_size):
     return image.resize(resize)
 
 
+def image_to_array(image):
+    """
+    Return the pixels of `image` as a flat uint8 array.
+
+    Pillow images are read straight from their raw buffer, without
+    creating a Python object per pixel, while uint8 arrays (drawn by the
+    numpy renderer) are used as they are.
+    """
+    if isinstance(image, np.ndarray):
+        return image.reshape(-1)
+    return np.frombuffer(image.tobytes(), dtype=np.uint8)
+
+
+def crop(image, box):
+    """
+    Return the (left, upper, right, lower) `box` region of a Pillow image or of an array.
+    """
+    if isinstance(image, np.ndarray):
+        left, upper, right, lower = box
+        return image[upper: lower, left: right]
+    return image.crop(box)
+
+
 class ImageEvaluator:
-    def __init__(self, target_image, dst_image_mode='RGB', resize=128):
+    def __init__(self, target_image, dst_image_mode='RGB', resize=128, pyramid_levels=0,
+                 sample_fraction=0, sample_sets=1, fold_symmetry=''):
         print('target_image =', target_image)
         print('Converting to', dst_image_mode)
         # Do not save alpha channel since JPEG does not support it
@@ -26,20 +67,538 @@ class ImageEvaluator:
         self.target_image = im
         self.dst_image_mode = dst_image_mode
         self.target_size = im.size
-        self.target_arr = np.asarray(im.getdata())
-        self.n_data = len(self.target_arr)
-        # Create here, one time, the numpy array, whose the creation is the bottleneck
-        self.candidate_arr = np.zeros(self.target_arr.shape, np.uint8)
+        # int16 is enough to hold the differences with uint8 candidates
+        self.target_arr = image_to_array(im).astype(np.int16)
+        width, height = self.target_size
+        self.n_data = width * height
+        # Same data as target_arr, but as (height, width, channels)
+        self.target_pixels = self.target_arr.reshape(height, width, -1)
+        # Rows accumulated at a time when evaluating with a threshold
+        self.band_rows = 32
+        # Target downsampled `pyramid_levels` times, halving its size each time:
+        # pyramid[level - 1] is the target at 1 / 2 ** level resolution
+        self.pyramid = []
+        for level in range(1, pyramid_levels + 1):
+            level_size = width >> level, height >> level
+            assert min(level_size) > 0, 'Too many pyramid levels: {}'.format(pyramid_levels)
+            level_image = im.resize(level_size, Image.BOX)
+            self.pyramid.append(image_to_array(level_image).astype(np.int16))
+        if self.pyramid:
+            print('Target pyramid: {} levels'.format(len(self.pyramid)))
+        # `sample_sets` random subsets of `sample_fraction` pixels:
+        # indices of their values in target_arr and the target values themselves
+        self.samples = []
+        rng = default_rng()
+        channels = self.target_pixels.shape[2]
+        n_sample_pixels = int(self.n_data * sample_fraction)
+        for _ in range(sample_sets if n_sample_pixels else 0):
+            pixels = np.sort(rng.choice(self.n_data, n_sample_pixels, replace=False))
+            indices = (pixels[:, np.newaxis] * channels + np.arange(channels)).ravel()
+            self.samples.append((indices, self.target_arr[indices]))
+        if self.samples:
+            print('Target samples: {} x {:,} pixels'.format(len(self.samples), n_sample_pixels))
+        # Target folded on the fundamental domain of the `fold_symmetry` mirror symmetry,
+        # to evaluate only its pixels (see `evaluate_folded`)
+        self.fold = self.folded_target(fold_symmetry) if fold_symmetry else None
+        self.create_buffers()
+        # Shared memory block name and specs of the SHARED_ATTRIBUTES arrays (see `share`)
+        self.shared = None
+
+    def __getstate__(self):
+        # Plain pickles (e.g. the status checkpoint) carry the arrays themselves,
+        # since the shared memory does not outlive the session
+        state = {key: value for key, value in self.__dict__.items() if key not in BUFFER_ATTRIBUTES}
+        state['shared'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.create_buffers()
+
+    def create_buffers(self):
+        """
+        Create, one time, the buffers of the evaluations (own of each process),
+        and the `target_pixels` view.
+        """
+        width, height = self.target_size
+        self.target_pixels = self.target_arr.reshape(height, width, -1)
+        # Squared differences
+        self.diff_arr = np.zeros(self.target_arr.shape, np.int32)
+        if self.fold is not None:
+            # Domain pixels and their errors
+            self.fold_pixels = np.empty(self.fold[1].shape, np.int32)
+            self.fold_diff = np.empty(self.fold[1].shape, np.int32)
+
+    def share(self):
+        """
+        Move the target arrays (and the pyramid, samples and fold tables)
+        to shared memory: the copies of the evaluator sent to other processes
+        by multiprocessing attach to them by name, instead of carrying them.
+
+        The memory is freed by `unlink`.
+        """
+        if self.shared is not None:
+            return
+        name, specs, arrays = share_arrays({key: getattr(self, key) for key in SHARED_ATTRIBUTES})
+        self.__dict__.update(arrays)
+        self.create_buffers()
+        self.shared = name, specs
+
+    def unlink(self):
+        """
+        Free the shared memory of `share` (when the processes using it are done).
+        """
+        if self.shared is not None:
+            unlink_arrays(self.shared[0])
+
+    def folded_target(self, symmetry):
+        """
+        Fold the target on the fundamental domain of the mirror `symmetry`
+        (see `drawer.mirror_pixels`).
+
+        Return the (rows, columns) of the upper-left box enclosing the domain,
+        for each pixel of the box the number of its mirror images (itself
+        included, zero outside the domain) and the doubled sums of their
+        target values, and the sum of the squared target values.
+        """
+        width, height = self.target_size
+        sources = mirror_pixels(np.arange(self.n_data).reshape(height, width), symmetry)
+        is_source = sources == np.arange(self.n_data).reshape(height, width)
+        rows = int(is_source.any(axis=1).sum())
+        columns = int(is_source.any(axis=0).sum())
+        sources = sources.ravel()
+        counts = np.bincount(sources, minlength=self.n_data).reshape(height, width, 1)
+        values = self.target_pixels.reshape(self.n_data, -1).astype(np.int64)
+        sums = np.stack([
+            np.bincount(sources, weights=channel, minlength=self.n_data)
+            for channel in values.T
+        ], axis=1).reshape(height, width, -1)
+        print('Target folded on {:,}/{:,} pixels'.format(int(is_source.sum()), self.n_data))
+        shape = rows, columns, values.shape[1]
+        return (
+            (rows, columns),
+            np.broadcast_to(counts[:rows, :columns], shape).astype(np.int32),
+            2 * sums[:rows, :columns].astype(np.int32),
+            int((values ** 2).sum()),
+        )
+
+    def evaluate(self, image, threshold=None):
+        """Sum of Squared Errors
+
+        If `threshold` is given, the sum is accumulated band of rows by band
+        of rows, and REJECTED is returned as soon as it reaches `threshold`.
+        """
+        if self.fold is not None:
+            return self.evaluate_folded(image, threshold)
+        candidate = image_to_array(image)
+        diff = self.diff_arr
+        if threshold is None:
+            np.subtract(candidate, self.target_arr, out=diff)
+            np.square(diff, out=diff)
+            return int(diff.sum(dtype=np.int64))
+
+        rv = 0
+        band_length = len(diff) // self.target_size[1] * self.band_rows
+        for start in range(0, len(diff), band_length):
+            stop = start + band_length
+            band = diff[start: stop]
+            np.subtract(candidate[start: stop], self.target_arr[start: stop], out=band)
+            np.square(band, out=band)
+            rv += int(band.sum(dtype=np.int64))
+            if rv >= threshold:
+                return REJECTED
+        return rv
+
+    def evaluate_folded(self, image, threshold=None):
+        """Sum of Squared Errors of a mirror symmetric `image`, evaluating only
+        its fundamental domain against the folded target (see `folded_target`).
+
+        Each domain pixel value p, with k mirror images of target values t,
+        contributes sum((p - t) ** 2) = (k * p - 2 * sum(t)) * p + sum(t ** 2).
+        """
+        (rows, columns), counts, double_sums, squares = self.fold
+        width, height = self.target_size
+        pixels = self.fold_pixels
+        np.copyto(pixels, image_to_array(image).reshape(height, width, -1)[:rows, :columns])
+        diff = self.fold_diff
+        np.multiply(counts, pixels, out=diff)
+        np.subtract(diff, double_sums, out=diff)
+        np.multiply(diff, pixels, out=diff)
+        rv = int(diff.sum(dtype=np.int64)) + squares
+        if threshold is not None and rv >= threshold:
+            return REJECTED
+        return rv
+
+    def evaluate_coarse(self, image, level):
+        """Sum of Squared Errors against the target at the pyramid `level`.
+        """
+        diff = np.subtract(image_to_array(image), self.pyramid[level - 1], dtype=np.int32)
+        return int(np.square(diff, out=diff).sum(dtype=np.int64))
+
+    def evaluate_sample(self, image, sample):
+        """Sum of Squared Errors on the pixels of the `sample` subset only.
+        """
+        indices, target = self.samples[sample]
+        diff = np.subtract(image_to_array(image)[indices], target, dtype=np.int32)
+        return int(np.square(diff, out=diff).sum(dtype=np.int64))
+
+    def evaluate_batch(self, candidates, chunk_size=16):
+        """
+        Sum of Squared Errors of many candidates at once.
+
+        Candidates are processed `chunk_size` at a time, to keep the
+        intermediate buffer small enough to stay in cache.
+
+        :param candidates: uint8 array of N stacked candidates, with shape (N, ...)
+        :return: int64 array of N evaluations
+        """
+        candidates = candidates.reshape(len(candidates), len(self.target_arr))
+        rv = np.zeros(len(candidates), np.int64)
+        diff = np.empty((chunk_size, len(self.target_arr)), np.int32)
+        for start in range(0, len(candidates), chunk_size):
+            chunk = candidates[start: start + chunk_size]
+            chunk_diff = diff[: len(chunk)]
+            np.subtract(chunk, self.target_arr, out=chunk_diff)
+            np.square(chunk_diff, out=chunk_diff)
+            chunk_diff.sum(axis=1, dtype=np.int64, out=rv[start: start + len(chunk)])
+        return rv
+
+    def error_map(self, image, box=None, threshold=None):
+        """
+        Return the per-pixel squared errors of `image` (one value per channel),
+        or of its (left, upper, right, lower) `box` region only.
+
+        If `threshold` is given, the map is computed band of rows by band
+        of rows, and None is returned as soon as its sum reaches `threshold`.
+        """
+        target = self.target_pixels
+        if box is not None:
+            left, upper, right, lower = box
+            image = crop(image, box)
+            target = target[upper: lower, left: right]
+        candidate = image_to_array(image).reshape(target.shape)
+        rv = np.subtract(candidate, target, dtype=np.int32)
+        if threshold is None:
+            return np.square(rv, out=rv)
+
+        total = 0
+        for start in range(0, len(target), self.band_rows):
+            band = rv[start: start + self.band_rows]
+            total += int(np.square(band, out=band).sum(dtype=np.int64))
+            if total >= threshold:
+                return None
+        return rv
+
+
+def reduce_image_evaluator(evaluator):
+    """
+    Pickle `evaluator` for another process: if shared, with the specs
+    of its shared arrays in place of the arrays (and without its buffers
+    and target image, created again on the other side).
+    """
+    if evaluator.shared is None:
+        return evaluator.__reduce_ex__(pickle.DEFAULT_PROTOCOL)
+    state = {key: value for key, value in evaluator.__dict__.items()
+             if key not in BUFFER_ATTRIBUTES + ('target_image',)}
+    state.update(evaluator.shared[1])
+    return rebuild_image_evaluator, (state,)
 
-    def evaluate(self, image):
-        """Mean Squared Error
+
+def rebuild_image_evaluator(state):
+    """
+    Return the evaluator pickled by `reduce_image_evaluator`, attached to its shared arrays.
+    """
+    evaluator = ImageEvaluator.__new__(ImageEvaluator)
+    evaluator.__dict__.update(state)
+    evaluator.__dict__.update(attach_arrays(*evaluator.shared))
+    evaluator.create_buffers()
+    evaluator.target_image = Image.frombytes(
+        evaluator.dst_image_mode, evaluator.target_size, evaluator.target_arr.astype(np.uint8).tobytes())
+    return evaluator
+
+
+ForkingPickler.register(ImageEvaluator, reduce_image_evaluator)
+
+
+class IncrementalEvaluator:
+    """
+    Evaluate genomes against a reference (father) genome, recomputing
+    the squared error only inside the box of the changed shapes.
+
+    Keep the per-pixel error map of the father, which is updated by
+    `set_father`.
+
+    Children differing from the father in a few positions are decoded
+    updating the father decoded shapes (see `ShapesEncoder.decode_update`).
+    """
+    # Children with more changed positions (like transposed ones) are decoded from scratch
+    max_update_positions = 16
+
+    def __init__(self, shapes_encoder, evaluator):
+        self.shapes_encoder = shapes_encoder
+        self.evaluator = evaluator
+        self.father = None
+        self.father_bits = None
+        self.father_decoded = None
+        self.father_error_map = None
+        # Region error map of the last evaluated child: (rv, box, region_map)
+        self.last_child = None
+
+    def set_father(self, father):
+        """
+        Use `father` (as returned by `func_evaluate`) as reference.
+        """
+        if father is self.father:
+            return
+        if self.last_child is not None and self.last_child[0] is father:
+            # Patch the current error map with the child region
+            _, box, region_map = self.last_child
+            if box is not None:
+                left, upper, right, lower = box
+                self.father_error_map[upper: lower, left: right] = region_map
+        else:
+            self.father_error_map = self.evaluator.error_map(father['phenotype'])
+        self.father = father
+        self.father_bits = genome_bits(father['genome'])
+        self.father_decoded = self.shapes_encoder.decode(father['genome'])
+        self.last_child = None
+
+    def decode(self, genome):
+        """
+        Return the decoded `genome` and the indices of its shape records
+        changed from the father (None if unknown).
+        """
+        if len(genome) == len(self.father_bits):
+            positions = np.flatnonzero(genome_bits(genome) != self.father_bits)
+            if len(positions) <= self.max_update_positions:
+                return self.shapes_encoder.decode_update(self.father_decoded, genome, positions)
+        return self.shapes_encoder.decode(genome), None
+
+    def __call__(self, genome, threshold=None, phenotype=None):
+        """
+        Evaluate `genome`, drawing its `phenotype` unless given.
+        """
+        decoded, records = self.decode(genome)
+        if phenotype is None:
+            phenotype = self.shapes_encoder.render(decoded)
+        box = self.shapes_encoder.dirty_box(self.father_decoded, decoded, records)
+        if box is None:
+            region_map = None
+            evaluation = self.father['evaluation']
+        else:
+            left, upper, right, lower = box
+            father_region = self.father_error_map[upper: lower, left: right]
+            # Evaluation of the father outside the box
+            outer = self.father['evaluation'] - int(father_region.sum(dtype=np.int64))
+            region_threshold = None if threshold is None else threshold - outer
+            region_map = self.evaluator.error_map(phenotype, box, threshold=region_threshold)
+            if region_map is None:
+                evaluation = REJECTED
+            else:
+                evaluation = outer + int(region_map.sum(dtype=np.int64))
+        if threshold is not None and evaluation >= threshold:
+            evaluation = REJECTED
+        rv = dict(genome=genome, phenotype=phenotype, evaluation=evaluation)
+        # Rejected children cannot become fathers
+        self.last_child = (rv, box, region_map) if evaluation is not REJECTED else None
+        return rv
+
+
+class CoarseToFineEvaluator:
+    """
+    Evaluate genomes first at the coarse levels of the target pyramid,
+    from the coarsest one, and at full resolution (with `evaluate`)
+    only if they pass them all.
+
+    A genome passes a level if its evaluation is better than the one of
+    the reference (father) genome, or worse by less than `margin` (relative).
+    """
+    def __init__(self, shapes_encoder, evaluator, evaluate, margin=0.0):
+        assert evaluator.pyramid, 'The evaluator has no target pyramid'
+        self.shapes_encoder = shapes_encoder
+        self.evaluator = evaluator
+        self.evaluate = evaluate
+        self.margin = margin
+        self.levels = list(range(len(evaluator.pyramid), 0, -1))
+        self.father = None
+        self.father_coarse_evaluations = {}
+        # Stats
+        self.n_screened = self.n_rejected = 0
+
+    def set_father(self, father):
+        """
+        Use `father` (as returned by `func_evaluate`) as reference.
+        """
+        if getattr(self.evaluate, 'set_father', None):
+            self.evaluate.set_father(father)
+        if father is self.father:
+            return
+        decoded = self.shapes_encoder.decode(father['genome'])
+        self.father_coarse_evaluations = {
+            level: self.evaluate_coarse(decoded, level) for level in self.levels
+        }
+        self.father = father
+
+    def report(self):
+        return 'Prescreen rejected/screened = {:,}/{:,}'.format(self.n_rejected, self.n_screened)
+
+    def evaluate_coarse(self, decoded, level):
+        image = self.shapes_encoder.render(decoded, scale=1 / 2 ** level)
+        return self.evaluator.evaluate_coarse(image, level)
+
+    def __call__(self, genome, threshold=None):
+        self.n_screened += 1
+        decoded = self.shapes_encoder.decode(genome)
+        for level in self.levels:
+            limit = self.father_coarse_evaluations[level] * (1 + self.margin)
+            if self.evaluate_coarse(decoded, level) >= limit:
+                self.n_rejected += 1
+                return dict(genome=genome, phenotype=None, evaluation=REJECTED)
+        return self.evaluate(genome, threshold)
+
+
+class SampledEvaluator:
+    """
+    Estimate the evaluation of genomes on a subset of pixels, and evaluate
+    them exactly only if the estimate is better than the one of the
+    reference (father) genome.
+
+    The exact evaluation is done with `evaluate`, if given, else on the
+    same image drawn for the estimate. `evaluate` is passed that image too,
+    so that it is not drawn again (see `IncrementalEvaluator` and `func_evaluate`).
+    The evaluator sample subsets are used in turn, one for each genome.
+    """
+    def __init__(self, shapes_encoder, evaluator, evaluate=None):
+        assert evaluator.samples, 'The evaluator has no pixel samples'
+        self.shapes_encoder = shapes_encoder
+        self.evaluator = evaluator
+        self.evaluate = evaluate
+        self.sample = 0
+        self.father = None
+        self.father_sample_evaluations = []
+        # Stats
+        self.n_estimated = self.n_rejected = 0
+
+    def set_father(self, father):
+        """
+        Use `father` (as returned by `func_evaluate`) as reference.
+        """
+        if getattr(self.evaluate, 'set_father', None):
+            self.evaluate.set_father(father)
+        if father is self.father:
+            return
+        self.father_sample_evaluations = [
+            self.evaluator.evaluate_sample(father['phenotype'], sample)
+            for sample in range(len(self.evaluator.samples))
+        ]
+        self.father = father
+
+    def report(self):
+        return 'Sampled rejected/estimated = {:,}/{:,}'.format(self.n_rejected, self.n_estimated)
+
+    def __call__(self, genome, threshold=None):
+        self.n_estimated += 1
+        self.sample = (self.sample + 1) % len(self.evaluator.samples)
+        phenotype = self.shapes_encoder.draw(genome)
+        estimate = self.evaluator.evaluate_sample(phenotype, self.sample)
+        if estimate >= self.father_sample_evaluations[self.sample]:
+            self.n_rejected += 1
+            return dict(genome=genome, phenotype=phenotype, evaluation=REJECTED)
+        if self.evaluate:
+            return self.evaluate(genome, threshold, phenotype=phenotype)
+        evaluation = self.evaluator.evaluate(phenotype, threshold)
+        return dict(genome=genome, phenotype=phenotype, evaluation=evaluation)
+
+
+class CachedEvaluator:
+    """
+    Memoize evaluations (not phenotypes) of genomes by their digest,
+    keeping the `maxsize` most recently used ones.
+
+    Evaluations of cache hits are returned without phenotype
+    (see `with_phenotype`).
+    """
+    def __init__(self, evaluate, maxsize=4096, evaluate_batch=None):
+        self.evaluate = evaluate
+        self.evaluate_batch = evaluate_batch
+        self.cache = LRUCache(maxsize)
+
+    def set_father(self, father):
+        if getattr(self.evaluate, 'set_father', None):
+            self.evaluate.set_father(father)
+        self.cache[genome_digest(father['genome'])] = father['evaluation']
+
+    def report(self):
+        return 'Cache hits/misses = {:,}/{:,} ({:.1%})'.format(
+            self.cache.hits, self.cache.misses, self.cache.hit_ratio)
+
+    def __call__(self, genome, threshold=None):
+        key = genome_digest(genome)
+        evaluation = self.cache.get(key)
+        if evaluation is not None:
+            return dict(genome=genome, phenotype=None, evaluation=evaluation)
+        rv = self.evaluate(genome, threshold)
+        # Early rejected evaluations are not exact
+        if rv['evaluation'] is not REJECTED:
+            self.cache[key] = rv['evaluation']
+        return rv
+
+    def batch(self, genomes):
+        """
+        Evaluate many `genomes`, passing the cache misses to `evaluate_batch`.
         """
-        self.candidate_arr[:] = image.getdata()
-        return ((self.target_arr - self.candidate_arr) ** 2).sum()
+        rv = []
+        missing = []
+        for genome in genomes:
+            key = genome_digest(genome)
+            evaluation = self.cache.get(key)
+            if evaluation is None:
+                missing.append((key, len(rv)))
+            rv.append(dict(genome=genome, phenotype=None, evaluation=evaluation))
+        evaluated = self.evaluate_batch([rv[i]['genome'] for key, i in missing])
+        for (key, i), ev_genome in zip(missing, evaluated):
+            self.cache[key] = ev_genome['evaluation']
+            rv[i] = ev_genome
+        return rv
 
 
-def func_evaluate(shapes_encoder, evaluator, genome):
+def with_phenotype(shapes_encoder, rv):
+    """
+    Return the evaluated genome `rv`, drawing its phenotype if missing
+    (like evaluations returned by the `CachedEvaluator`).
+    """
+    if rv['phenotype'] is None:
+        rv = dict(rv, phenotype=shapes_encoder.draw(rv['genome']))
+    return rv
+
+
+def stack_images(images):
+    """
+    Stack Pillow `images` (with the same size and mode) in a 2D uint8 array,
+    one flattened image per row.
+    """
+    images = list(images)
+    if not images:
+        return np.zeros((0, 0), np.uint8)
+    rv = np.empty((len(images), len(image_to_array(images[0]))), np.uint8)
+    for i, image in enumerate(images):
+        rv[i] = image_to_array(image)
+    return rv
+
+
+def func_evaluate(shapes_encoder, evaluator, genome, threshold=None, phenotype=None):
     """Utility function."""
-    phenotype = shapes_encoder.draw(genome)
-    evaluation = evaluator.evaluate(phenotype)
+    if phenotype is None:
+        phenotype = shapes_encoder.draw(genome)
+    evaluation = evaluator.evaluate(phenotype, threshold)
     return dict(genome=genome, phenotype=phenotype, evaluation=evaluation)
+
+
+def func_evaluate_batch(shapes_encoder, evaluator, genomes):
+    """Like `func_evaluate`, but evaluate many `genomes` in a single call."""
+    phenotypes = [shapes_encoder.draw(genome) for genome in genomes]
+    evaluations = evaluator.evaluate_batch(stack_images(phenotypes))
+    return [
+        dict(genome=genome, phenotype=phenotype, evaluation=int(evaluation))
+        for genome, phenotype, evaluation in zip(genomes, phenotypes, evaluations)
+    ]
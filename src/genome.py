@@ -1,21 +1,173 @@
 from collections import Counter
-from itertools import combinations
-from math import factorial as f
+from hashlib import blake2b
+from itertools import accumulate
+from math import exp, lgamma, log, log1p
 from random import random as rand
-from random import choice, sample
+from random import getrandbits, sample
 try:
     from random import choices
 except ImportError:
     print('choices backported!')
     from backports import choices
 
+import numpy as np
 
-def generate(bases, length):
+from transpose import transposed
+from utils import FenwickTree
+
+
+class PackedGenome:
+    """
+    Genome with the bases packed as bits, 8 per byte (`numpy.packbits` order).
+
+    Immutable and hashable like the legacy strings of '0' and '1',
+    but 8 times smaller. `str()` returns the legacy string form.
+    Unused bits of the last byte are always 0.
+    """
+    __slots__ = ('data', 'length')
+
+    def __init__(self, data, length):
+        self.data = bytes(data)
+        self.length = length
+
+    @classmethod
+    def from_bits(cls, bits):
+        """
+        Pack a sequence of 0 and 1.
+        """
+        return cls(np.packbits(np.asarray(bits, dtype=np.uint8)).tobytes(), len(bits))
+
+    @classmethod
+    def from_string(cls, genome):
+        """
+        Pack a legacy string genome.
+        """
+        return cls.from_bits(genome_bits(genome))
+
+    def bits(self):
+        """
+        Return the bases as an uint8 array of 0 and 1.
+        """
+        return np.unpackbits(np.frombuffer(self.data, dtype=np.uint8), count=self.length)
+
+    def to_string(self):
+        """
+        Return the legacy string form.
+        """
+        return (self.bits() + ord('0')).tobytes().decode()
+
+    def __str__(self):
+        return self.to_string()
+
+    def __repr__(self):
+        return 'PackedGenome.from_string({!r})'.format(self.to_string())
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return iter(self.bits().tolist())
+
+    def __eq__(self, other):
+        if not isinstance(other, PackedGenome):
+            return NotImplemented
+        return self.length == other.length and self.data == other.data
+
+    def __hash__(self):
+        return hash((self.data, self.length))
+
+    def xor(self, mask):
+        """
+        Return the genome with the bases flipped where the int `mask` has bits set
+        (the most significant bit of the first byte is the base 0).
+        """
+        n_bytes = len(self.data)
+        value = int.from_bytes(self.data, 'big') ^ mask
+        return PackedGenome(value.to_bytes(n_bytes, 'big'), self.length)
+
+    def positions_mask(self, positions):
+        """
+        Return the int mask of the bases in `positions`, for `xor`.
+        """
+        last = len(self.data) * 8 - 1
+        mask = 0
+        for pos in positions:
+            if not 0 <= pos < self.length:
+                raise IndexError('genome position out of range: {}'.format(pos))
+            mask ^= 1 << (last - pos)
+        return mask
+
+
+def to_packed(genome):
+    """
+    Return `genome` as a `PackedGenome`.
+    """
+    return genome if isinstance(genome, PackedGenome) else PackedGenome.from_string(genome)
+
+
+def to_string(genome):
+    """
+    Return `genome` in the legacy string form.
+    """
+    return genome if isinstance(genome, str) else genome.to_string()
+
+
+def join_bases(bases, packed=False):
+    """
+    Return the genome made of `bases` (as '0' and '1' or 0 and 1),
+    packed or in the legacy string form.
+    """
+    if packed:
+        return PackedGenome.from_bits([int(base) for base in bases])
+    return ''.join([str(base) for base in bases])
+
+
+def default_rng(rng=None):
+    """
+    Return `rng`, or a numpy Generator seeded from the `random` module
+    (so that `random.seed` still makes the results reproducible).
+    """
+    return np.random.default_rng(getrandbits(64)) if rng is None else rng
+
+
+def random_bits(shape, rng=None):
+    """
+    Return an uint8 array of random 0 and 1, drawn 8 at a time from random bytes.
+    """
+    size = int(np.prod(shape))
+    data = np.frombuffer(default_rng(rng).bytes((size + 7) // 8), dtype=np.uint8)
+    return np.unpackbits(data, count=size).reshape(shape)
+
+
+def generate(bases, length, rng=None):
     """Generate random 01 string."""
-    return ''.join([choice(bases) for _ in range(length)])
+    if bases == '01':
+        return (random_bits(length, rng) + ord('0')).tobytes().decode()
+    indices = default_rng(rng).integers(len(bases), size=length)
+    return np.frombuffer(bases.encode(), dtype=np.uint8)[indices].tobytes().decode()
+
+
+def genome_digest(genome):
+    """
+    Return a short digest identifying `genome` (the same in every process).
+    """
+    if isinstance(genome, PackedGenome):
+        return blake2b(genome.data + genome.length.to_bytes(8, 'big'), digest_size=16).digest()
+    return blake2b(genome.encode(), digest_size=16).digest()
+
+
+def genome_bits(genome):
+    """
+    Return the bases of `genome` as an uint8 array of 0 and 1.
+    """
+    if isinstance(genome, PackedGenome):
+        return genome.bits()
+    return np.frombuffer(genome.encode(), dtype=np.uint8) - ord('0')
 
 
 def opposite_genome(genome):
+    if isinstance(genome, PackedGenome):
+        return genome.xor(genome.positions_mask(range(len(genome))))
     rv = []
     for base in genome:
         rv.append(str(int(not int(base))))
@@ -31,18 +183,79 @@ def genetic_distances(*genomes):
     >>> r = genetic_diff('0000', '1111', '0000')
     [2.0, 0.0, 2.0]
     """
-    rv = []
-    for genome_a, genome_b in combinations(genomes, 2):
-        rv.append(sum((abs(int(a) - int(b)) for a, b in zip(genome_a, genome_b))))
-    return rv
+    matrix = distance_matrix(genomes)
+    return matrix[np.triu_indices(len(genomes), 1)].tolist()
+
+
+# Number of bits set of each byte value
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1).sum(axis=1)
+# Masks of the first k bits of a byte
+PREFIX_MASKS = np.array([(0xFF << (8 - k)) & 0xFF for k in range(8)], dtype=np.uint8)
+
+
+def pack_genomes(genomes):
+    """
+    Return the bases of `genomes` packed in the rows of an uint8 matrix
+    (padded with zeros to the longest one), and their lengths.
+    """
+    lengths = np.array([len(genome) for genome in genomes], dtype=np.int64)
+    n_bytes = (int(lengths.max(initial=0)) + 7) // 8
+    rows = np.zeros((len(genomes), n_bytes), dtype=np.uint8)
+    for row, genome in zip(rows, genomes):
+        data = genome.data if isinstance(genome, PackedGenome) else np.packbits(genome_bits(genome))
+        row[: len(data)] = np.frombuffer(data, dtype=np.uint8)
+    return rows, lengths
+
+
+def _distances(row, length, rows, lengths):
+    """
+    Return the Hamming distances of the packed genome `row` from each of the packed `rows`,
+    on their common prefix (as `genetic_distances` does with zip).
+    """
+    n_bytes = rows.shape[1]
+    if not n_bytes:
+        return np.zeros(len(rows), dtype=np.int64)
+    differences = row ^ rows
+    cumulative = np.zeros((len(rows), n_bytes + 1), dtype=np.int64)
+    np.cumsum(POPCOUNT[differences], axis=1, out=cumulative[:, 1:])
+    common = np.minimum(length, lengths)
+    full_bytes = common // 8
+    indices = np.arange(len(rows))
+    # Whole bytes, plus the first bits of the next one
+    last = differences[indices, np.minimum(full_bytes, n_bytes - 1)] & PREFIX_MASKS[common % 8]
+    return cumulative[indices, full_bytes] + POPCOUNT[last]
+
+
+def distance_matrix(genomes):
+    """
+    Return the (n, n) matrix of the genetic (Hamming) distances between all `genomes`,
+    computed with popcounts on the packed bases.
+    """
+    rows, lengths = pack_genomes(genomes)
+    matrix = np.zeros((len(genomes), len(genomes)), dtype=np.int64)
+    for i, (row, length) in enumerate(zip(rows, lengths)):
+        matrix[i, i + 1:] = _distances(row, length, rows[i + 1:], lengths[i + 1:])
+    return matrix + matrix.T
+
+
+def distances_to(genome, genomes):
+    """
+    Return the array of the genetic distances of `genome` from each one of `genomes`.
+    """
+    rows, lengths = pack_genomes([genome] + list(genomes))
+    return _distances(rows[0], lengths[0], rows[1:], lengths[1:])
 
 
 def flip_mutate(positions, genome):
     """
     Flip `genome` bases in `positions`.
 
-    :rtype: str
+    Packed genomes are flipped with a xor.
+
+    :rtype: str or PackedGenome
     """
+    if isinstance(genome, PackedGenome):
+        return genome.xor(genome.positions_mask(positions))
     ret = list(genome)
     for pos in positions:
         if ret[pos] == '0':
@@ -52,6 +265,16 @@ def flip_mutate(positions, genome):
     return ''.join(ret)
 
 
+def transpose_genome(genome, start, end, dst, replicative=False, inverted=False):
+    """
+    Return a copy of `genome` with a transposition (see `transpose.transposed`).
+    """
+    if isinstance(genome, PackedGenome):
+        return PackedGenome.from_bits(
+            transposed(genome.bits(), start, end, dst, replicative=replicative, inverted=inverted))
+    return transposed(genome, start, end, dst, replicative=replicative, inverted=inverted)
+
+
 def get_rand_positions(length, mutation_rate):
     """
     Extract a random number of random positions within `length`, given
@@ -80,17 +303,23 @@ def get_probs_k_mutations(n, mutation_rate, cutoff=1e-12):
     Restituisce la lista di probabilità che avvengano
     esattamente k mutazioni, per k che va da 0 a `n`.
 
-    Quando la probabiltà scende sotto un certo valore di `cutoff`,
-    le restanti probabilità vengono settate a 0.
+    Quando la probabiltà scende sotto un certo valore di `cutoff`
+    (oltre la moda), le restanti probabilità vengono settate a 0.
+
+    Calcolate in spazio logaritmico, senza fattoriali, anche per genomi lunghi.
     """
     probs = [0] * (n + 1)
+    if mutation_rate <= 0 or mutation_rate >= 1:
+        probs[n if mutation_rate >= 1 else 0] = 1
+        return probs
+    log_rate = log(mutation_rate)
+    log_keep = log1p(-mutation_rate)
+    log_n = lgamma(n + 1)
+    mode = n * mutation_rate
     for k in range(n + 1):
-        p_k = (f(n) / (f(k) * f(n - k))) * \
-              (mutation_rate ** k) * \
-              (1 - mutation_rate) ** (n - k)
+        p_k = exp(log_n - lgamma(k + 1) - lgamma(n - k + 1) + k * log_rate + (n - k) * log_keep)
         probs[k] = p_k
-        if p_k < cutoff:
-            probs[k: n + 1] = [0] * (n - k)
+        if p_k < cutoff and k > mode:
             break
     return probs
 
@@ -109,6 +338,95 @@ def fast_rand_mut_positions_generator(genome_length, mutation_rate, n_extraction
         yield sample(range(genome_length), n_mutations)
 
 
+def rand_n_mutations(genome_length, mutation_rate, batch_size=1024):
+    """
+    Generatore infinito del numero di mutazioni di un genoma lungo `genome_length`,
+    estratto a blocchi di `batch_size` dalla distribuzione binomiale precalcolata.
+    """
+    probs = get_probs_k_mutations(genome_length, mutation_rate)
+    n_max = max(k for k, p_k in enumerate(probs) if p_k)
+    cum_weights = list(accumulate(probs[: n_max + 1]))
+    n_mutations = range(n_max + 1)
+    while True:
+        yield from choices(n_mutations, cum_weights=cum_weights, k=batch_size)
+
+
+def rand_mut_positions(genome_length, mutation_rate, batch_size=1024):
+    """
+    Generatore infinito di liste di posizioni di mutazione, con la stessa
+    distribuzione di `get_rand_positions`, ma in O(k) per k mutazioni
+    (le posizioni sono estratte con `sample`).
+    """
+    population = range(genome_length)
+    for k in rand_n_mutations(genome_length, mutation_rate, batch_size):
+        yield sample(population, k)
+
+
+class AdaptiveMutationRates:
+    """
+    Per-base mutation rates learnt from the good and bad mutations counts.
+
+    The weight of each base is its smoothed success ratio,
+    (good + 1) / (good + bad + 2), so that bases whose flips never improve
+    (e.g. the ones of invisible shapes) are drawn less and less.
+    Positions are drawn through a Fenwick tree of the weights,
+    updated in O(log n) at each new count.
+    """
+    def __init__(self, genome_length, good_counts=(), bad_counts=()):
+        """
+        :param good_counts: good mutations count of each position so far
+        :param bad_counts: bad mutations count of each position so far
+        """
+        self.good = [0] * genome_length
+        self.bad = [0] * genome_length
+        for counts, initial_counts in ((self.good, good_counts), (self.bad, bad_counts)):
+            initial_counts = [int(count) for count in initial_counts[:genome_length]]
+            counts[: len(initial_counts)] = initial_counts
+        self.tree = FenwickTree([self.weight(position) for position in range(genome_length)])
+
+    def __repr__(self):
+        return 'AdaptiveMutationRates[{}]'.format(len(self.good))
+
+    def weight(self, position):
+        good = self.good[position]
+        return (good + 1) / (good + self.bad[position] + 2)
+
+    def rates(self, k_mut):
+        """
+        Return the list of the mutation rates of the bases, summing to `k_mut`.
+        """
+        total = self.tree.total
+        return [k_mut * self.weight(position) / total for position in range(len(self.good))]
+
+    def update(self, positions, improved):
+        """
+        Count the flip of `positions` as a good (`improved`) or bad mutation.
+        """
+        counts = self.good if improved else self.bad
+        for position in positions:
+            weight = self.weight(position)
+            counts[position] += 1
+            self.tree.add(position, self.weight(position) - weight)
+
+    def sample(self, k):
+        """
+        Draw `k` different positions, with probability proportional to their weight.
+        """
+        k = min(k, len(self.good))
+        positions = set()
+        tree = self.tree
+        while len(positions) < k:
+            positions.add(tree.find(rand() * tree.total))
+        return list(positions)
+
+    def rand_positions(self, mutation_rate, batch_size=1024):
+        """
+        Same as `rand_mut_positions`, drawing the positions with the adaptive rates.
+        """
+        for k in rand_n_mutations(len(self.good), mutation_rate, batch_size):
+            yield self.sample(k)
+
+
 ##########################################################################
 ######### Per vedere e confrontare i due tipi di distribuzione ###########
 ##########################################################################
@@ -10,6 +10,11 @@ from copy import deepcopy
 from hashlib import sha1
 from pprint import pformat
 
+import numpy as np
+
+from drawer import as_image
+from genome import to_string
+
 p_join = os.path.join
 
 DATA_FILENAME = 'status.pkl'
@@ -21,6 +26,7 @@ PLOT_FILENAME = 'plot.png'
 
 ISLA_GENOMES_FILENAME = 'generations.txt'
 CROSSOVER_GENOMES_FILENAME = 'crossover_generations.txt'
+MUTATION_COUNTS_FILENAME = 'mutation_counts.npz'
 
 
 def _get_id(options):
@@ -45,8 +51,19 @@ def get_cleared_options(options):
     return cleared_options
 
 
+def load_mutation_counts(filepath):
+    """
+    Return the good and bad mutation counts arrays saved by `HistoryIO.save_island_stuff`.
+    """
+    with np.load(filepath) as data:
+        return data['good'], data['bad']
+
+
 def write_genome(fp, iteration, genome):
-    fp.write('{i:>9}    {g}\n'.format(i=iteration, g=genome))
+    """
+    Write `genome` (string or packed) in the legacy text form.
+    """
+    fp.write('{i:>9}    {g}\n'.format(i=iteration, g=to_string(genome)))
 
 
 class HistoryIO:
@@ -107,7 +124,7 @@ class HistoryIO:
         assert self.cleared_options.__dict__ == eval(txt)
 
     def save_island_stuff(
-            self, island, save_phenotype=False, save_good_mutations=False):
+            self, island, save_phenotype=False, save_good_mutations=False, save_mutation_counts=False):
         dirpath = p_join(self.dirpath, island.id)
         os.makedirs(dirpath, exist_ok=True)
 
@@ -117,6 +134,13 @@ class HistoryIO:
         with open(p_join(dirpath, ISLA_GENOMES_FILENAME), 'a') as fp:
             write_genome(fp, iteration, genome)
 
+        if save_mutation_counts:
+            # Good and bad flips of each position (see `load_mutation_counts`)
+            np.savez_compressed(
+                p_join(dirpath, MUTATION_COUNTS_FILENAME),
+                good=island.good_mutation_counts, bad=island.bad_mutation_counts,
+            )
+
         if save_phenotype:
             target = island.evaluator.target_filepath
             now = datetime.datetime.now()
@@ -129,7 +153,7 @@ class HistoryIO:
                     mse=island.best_evaluation,
                 )
             )
-            island.best['phenotype'].save(dst)
+            as_image(island.best['phenotype']).save(dst)
             return dst
 
         if save_good_mutations:
@@ -142,6 +166,8 @@ class HistoryIO:
     def save(self, status):
         with open(self.filepath, 'wb') as fp:
             pickle.dump(status, fp)
+        # The islands carry the same state when sent to the Pool processes
+        print('Status saved: {:,} B/island'.format(os.path.getsize(self.filepath) // len(status['islands'])))
 
     def init_stats(self, status, plot=False):
         islands = status['islands']
@@ -186,10 +212,11 @@ class HistoryIO:
     def update_plot(self):
         os.system("gnuplot '{}'".format(self.gnuplot_script_path))
 
-    def update_genomes_stuff(self, status, save_good_mutations=False):
+    def update_genomes_stuff(self, status, save_good_mutations=False, save_mutation_counts=False):
         """Save genomes and mutations"""
         for isla in status['islands']:
-            self.save_island_stuff(isla, save_good_mutations=save_good_mutations)
+            self.save_island_stuff(
+                isla, save_good_mutations=save_good_mutations, save_mutation_counts=save_mutation_counts)
 
         iteration = isla.iteration  # TODO: refactoring
         crossover_genome = status['best_ev_offspring']['genome']
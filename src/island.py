@@ -1,13 +1,34 @@
 import time
-from collections import Counter
 from functools import partial
 from hashlib import md5
 from random import random as rand
 from random import randrange
 
-from evaluator import func_evaluate
-from genome import flip_mutate, get_rand_positions
-from transpose import transpose
+import numpy as np
+
+from evaluator import (
+    CachedEvaluator, CoarseToFineEvaluator, IncrementalEvaluator, SampledEvaluator,
+    func_evaluate, func_evaluate_batch, with_phenotype,
+)
+from genome import AdaptiveMutationRates, flip_mutate, rand_mut_positions, to_packed, to_string, transpose_genome
+from layer_cache import LayerCache
+from utils import LRUCache
+
+
+def resized(counts, length):
+    """
+    Return the `counts` array with `length` elements (truncated or padded with zeros).
+    """
+    if len(counts) == length:
+        return counts
+    rv = np.zeros(length, counts.dtype)
+    rv[: min(length, len(counts))] = counts[: length]
+    return rv
+
+
+# Island attributes created again by `Island.create_derived`, instead of being pickled
+# (the contents of the evaluations caches are pickled, see `Island.__getstate__`)
+DERIVED_ATTRIBUTES = ('layer_cache', 'evaluate', 'evaluate_batch', 'child_evaluators', 'mutation_rates')
 
 
 class Island:
@@ -23,43 +44,122 @@ class Island:
                  p_transposition=0.5,
                  p_inverted=0.01,  # use the main transposition random call ("absolute" p)
                  p_transposition_replicative=0.1,  # another random call in case of transposition
+                 incremental=False,  # evaluate only the region of the changed shapes
+                 prescreen_margin=None,  # evaluate first at coarse resolutions (needs the evaluator pyramid)
+                 sampled=False,  # estimate evaluations on pixel samples first (needs the evaluator samples)
+                 cache_size=0,  # size of the LRU cache of evaluations (0 = no cache)
+                 layer_cache=0,  # snapshot the best canvas every this many layers (0 = disabled)
+                 packed=False,  # keep genomes packed as bits (see genome.PackedGenome)
+                 p_position=False,  # adapt the mutation rate of each base to its good/bad mutations
+                 n_mutants=1,  # children generated from the best at each step, the best one replacing it (1 + lambda)
+                 rejection_cache=4096,  # size of the LRU cache of the mutations rejected by the best (0 = disabled)
                  ):
         self.index = index
         self.shapes_encoder = shapes_encoder
         self.evaluator = evaluator
-        self.evaluate = partial(func_evaluate, shapes_encoder, evaluator)
+        self.n_mutants = n_mutants
+        # Options of the state derived from the rest, not pickled (see `create_derived`)
+        self.derived_options = dict(
+            layer_cache=layer_cache, incremental=incremental, sampled=sampled, prescreen_margin=prescreen_margin,
+            cache_size=cache_size, p_position=p_position,
+        )
         self.run_iterations = run_iterations
 
         # Mutations
         self.k_mut = k_mut
         genome_size = self.shapes_encoder.genome_size
-        self.p_mutations = [self.k_mut / genome_size] * genome_size
-        self.good_mutation_counter = Counter()
-        self.bad_mutation_counter = Counter()
+        # Good and bad flips of each genome position
+        self.good_mutation_counts = np.zeros(genome_size, np.uint32)
+        self.bad_mutation_counts = np.zeros(genome_size, np.uint32)
         self.p_transposition = p_transposition
         self.p_inverted = p_inverted
         self.p_transposition_replicative = p_transposition_replicative
         if p_transposition_replicative > 0:
             print('Replicative transposition enabled: {}'.format(p_transposition_replicative))
+        # Mutations (flip positions or transpositions) rejected by the current best, to skip them
+        self.rejected = LRUCache(rejection_cache) if rejection_cache else None
         # Salva le mutazioni buone dell'ultimo ciclo di run
         self.last_run_good_mutations = []
 
         # Stats
         self.iteration = 0
         self.t_saved = 0
+        self.last_run_flips = (np.zeros(0, np.uint32), np.zeros(0, np.uint32))  # good and bad flipped positions
 
-        genome = genome if genome else self.shapes_encoder.generate()
+        self.packed = packed
+        self.create_derived()
+        genome = genome if genome else self.shapes_encoder.generate(packed=packed)
+        if packed:
+            genome = to_packed(genome)
         assert len(genome) == genome_size, '{} != {}'.format(len(genome), genome_size)
         self.best = self.evaluate(genome)
         self.adam = genome
-        self.id = md5(genome.encode()).hexdigest()
+        self.id = md5(to_string(genome).encode()).hexdigest()
         self.short_id = self.id[:7]
         self.run_delta_evaluation = 0  # delta evaluation between run end and run start
-        self.animation_frames = []
 
     def __repr__(self):
         return 'Island#{}'.format(self.index)
 
+    def __getstate__(self):
+        # Checkpoints and transfers to other processes carry neither the derived state
+        # nor the phenotype of the best, drawn again when needed
+        state = self.__dict__.copy()
+        for key in DERIVED_ATTRIBUTES:
+            del state[key]
+        state['best'] = dict(self.best, phenotype=None)
+        # The contents of the evaluations caches survive, as the rejection cache does
+        state['evaluation_caches'] = [
+            child.cache for child in self.child_evaluators if isinstance(child, CachedEvaluator)]
+        return state
+
+    def __setstate__(self, state):
+        caches = state.pop('evaluation_caches')
+        self.__dict__.update(state)
+        self.create_derived()
+        for child, cache in zip(
+                [child for child in self.child_evaluators if isinstance(child, CachedEvaluator)], caches):
+            child.cache = cache
+
+    def create_derived(self):
+        """
+        Create the state derived from the rest of the island (see `derived_options`):
+        evaluation functions, layer cache and adaptive mutation rates.
+        """
+        options = self.derived_options
+        shapes_encoder = self.shapes_encoder
+        evaluator = self.evaluator
+        # Render children from the snapshots of the best drawing (see set_best)
+        self.layer_cache = LayerCache(shapes_encoder, options['layer_cache']) if options['layer_cache'] else None
+        renderer = self.layer_cache or shapes_encoder
+        self.evaluate = partial(func_evaluate, renderer, evaluator)
+        self.evaluate_batch = partial(func_evaluate_batch, renderer, evaluator)
+        # Evaluate children with respect to their father (see set_best),
+        # each child evaluator wrapping the previous one
+        self.child_evaluators = []
+        if options['incremental']:
+            self.child_evaluators.append(IncrementalEvaluator(renderer, evaluator))
+        if options['sampled']:
+            self.child_evaluators.append(SampledEvaluator(
+                renderer, evaluator, self.child_evaluator))
+        if options['prescreen_margin'] is not None:
+            self.child_evaluators.append(CoarseToFineEvaluator(
+                renderer, evaluator, self.child_evaluator or self.evaluate, options['prescreen_margin']))
+        if options['cache_size']:
+            self.child_evaluators.append(CachedEvaluator(self.child_evaluator or self.evaluate, options['cache_size']))
+        self.mutation_rates = AdaptiveMutationRates(
+            shapes_encoder.genome_size, self.good_mutation_counts, self.bad_mutation_counts,
+        ) if options['p_position'] else None
+
+    @property
+    def p_mutations(self):
+        genome_size = self.shapes_encoder.genome_size
+        return [self.k_mut / genome_size] * genome_size
+
+    @property
+    def child_evaluator(self):
+        return self.child_evaluators[-1] if self.child_evaluators else None
+
     @property
     def best_evaluation(self):
         return self.best['evaluation']
@@ -68,15 +168,67 @@ class Island:
         """Function called in case of fitness improvement."""
         # update good mutations
         self.last_run_good_mutations.append((self.iteration, mutation))
-        if mutation[0] == 'flip':
-            self.good_mutation_counter.update(mutation[1])
+        if mutation[0] == 'F' and self.mutation_rates:
+            self.mutation_rates.update(mutation[1], improved=True)
 
     def fitness_fail(self, mutation, *args, **kwargs):
         """Function called in case of fitness decreased."""
         pass
 
+    def count_mutations(self, good_positions, bad_positions):
+        """
+        Add the flipped positions of the good and bad mutations to the counts,
+        resized to the best genome length.
+        """
+        length = max(len(self.best['genome']), self.shapes_encoder.genome_size)
+        for name, positions in (('good_mutation_counts', good_positions), ('bad_mutation_counts', bad_positions)):
+            counts = resized(getattr(self, name), length)
+            counts += np.bincount(np.asarray(positions, np.int64), minlength=length)[: length].astype(counts.dtype)
+            setattr(self, name, counts)
+
+    def run_summary(self):
+        """
+        Return the compact results of the last run, to update a copy
+        of the island in another process (see `apply_run_summary`).
+        """
+        return {
+            'index': self.index,
+            'genome': to_packed(self.best['genome']),
+            'evaluation': self.best['evaluation'],
+            'iteration': self.iteration,
+            'run_delta_evaluation': self.run_delta_evaluation,
+            'last_run_good_mutations': self.last_run_good_mutations,
+            'flips': self.last_run_flips,
+            't_saved': self.t_saved,
+        }
+
+    def apply_run_summary(self, summary):
+        """
+        Update the island with the `run_summary` of a run of its copy.
+
+        The phenotype of the new best is not drawn (see `evaluator.with_phenotype`),
+        nor are the mutation rates updated: the copy does not sample mutations,
+        and they are created again from the counts when unpickled (see `create_derived`).
+        """
+        genome = summary['genome'] if self.packed else to_string(summary['genome'])
+        if genome != self.best['genome']:
+            self.best = dict(genome=genome, phenotype=None, evaluation=summary['evaluation'])
+        self.iteration = summary['iteration']
+        self.run_delta_evaluation = summary['run_delta_evaluation']
+        self.last_run_good_mutations = summary['last_run_good_mutations']
+        self.last_run_flips = summary['flips']
+        self.t_saved = summary['t_saved']
+        self.count_mutations(*self.last_run_flips)
+
     def set_best(self, best):
+        best = with_phenotype(self.shapes_encoder, best)
         self.best = best
+        if self.rejected is not None:
+            self.rejected.clear()
+        if self.layer_cache:
+            self.layer_cache.set_reference(best['genome'])
+        if self.child_evaluator:
+            self.child_evaluator.set_father(best)
 
     def run(self):
         t_0 = time.time()
@@ -84,8 +236,18 @@ class Island:
         self.last_run_good_mutations = []
 
         evaluate = self.evaluate
+        if self.layer_cache:
+            self.layer_cache.set_reference(self.best['genome'])
+        if self.child_evaluator:
+            self.best = with_phenotype(self.shapes_encoder, self.best)
+            self.child_evaluator.set_father(self.best)
+            evaluate = self.child_evaluator
         genome_size = self.shapes_encoder.genome_size
         mut_rate = self.k_mut / genome_size
+        if self.mutation_rates:
+            rand_positions = self.mutation_rates.rand_positions(mut_rate)
+        else:
+            rand_positions = rand_mut_positions(genome_size, mut_rate)
         start_iteration = self.iteration
 
         father_evaluation = self.best['evaluation']
@@ -97,68 +259,113 @@ class Island:
         n_evaluations = n_skipped_evaluations = 0
         t_sk_tot = t_ev_tot = 0
         failed_iterations = successful_iterations = 0
-        bad_mutations = set()
-        while self.iteration - start_iteration < self.run_iterations:
-            self.iteration += 1
-            if (self.iteration - start_iteration) == self.run_iterations:
-                break
-
-            transpose_rand = rand()
-            if transpose_rand < self.p_transposition:
-                inverted = transpose_rand <= self.p_inverted
-                replicative = rand() < self.p_transposition_replicative
-                if transpose_rand < self.p_transposition / 2:
-                    start, end, dst = sorted([randrange(genome_size), randrange(genome_size), randrange(genome_size)])
+        rejected = self.rejected
+        good_flips = []
+        bad_flips = []
+        # Phenotypes no longer used are given back to the canvas pool,
+        # except the starting best one, which can be referenced outside
+        release = self.shapes_encoder.release
+        drawn_father = False
+        done = False
+        while not done:
+            # Generate up to n_mutants children of the father (1 + lambda)
+            mutants = []
+            while len(mutants) < self.n_mutants:
+                self.iteration += 1
+                if (self.iteration - start_iteration) >= self.run_iterations:
+                    done = True
+                    break
+
+                mut_positions = None
+                transpose_rand = rand()
+                if transpose_rand < self.p_transposition:
+                    inverted = transpose_rand <= self.p_inverted
+                    replicative = rand() < self.p_transposition_replicative
+                    if transpose_rand < self.p_transposition / 2:
+                        start, end, dst = sorted([
+                            randrange(genome_size), randrange(genome_size), randrange(genome_size)])
+                    else:
+                        dst, start, end = sorted([
+                            randrange(genome_size), randrange(genome_size), randrange(genome_size)])
+                    mutation = ('T', (start, end, dst, replicative, inverted))
+                    key = mutation
                 else:
-                    dst, start, end = sorted([randrange(genome_size), randrange(genome_size), randrange(genome_size)])
-                transposing = list(father_genome)
-                transpose(transposing, start, end, dst, replicative=replicative, inverted=inverted)
-                child_genome = ''.join(transposing)
-                mutation = ('T', (start, end, dst, replicative, inverted))
-            else:
-                # Generate random mutation positions
-                # frozenset is to cache bad mutations
-                mut_positions = frozenset(get_rand_positions(genome_size, mut_rate))
-                mutation = ('F', tuple(mut_positions))
+                    # Generate random mutation positions
+                    # frozenset is to cache bad mutations
+                    mut_positions = frozenset(next(rand_positions))
+                    mutation = ('F', tuple(mut_positions))
+                    key = mut_positions
 
                 # Check cached bad mutations
-                t_sk_ev_0 = time.time()
-                if len(mut_positions) < 3:
-                    if mut_positions in bad_mutations:
+                if rejected is not None:
+                    t_sk_ev_0 = time.time()
+                    if rejected.get(key):
                         n_skipped_evaluations += 1
                         t_sk_tot += time.time() - t_sk_ev_0
                         continue
                     t_sk_tot += time.time() - t_sk_ev_0
 
-                child_genome = flip_mutate(mut_positions, father_genome)
+                if mut_positions is None:
+                    child_genome = transpose_genome(
+                        father_genome, start, end, dst, replicative=replicative, inverted=inverted)
+                else:
+                    child_genome = flip_mutate(mut_positions, father_genome)
+                mutants.append((mutation, mut_positions, key, child_genome))
+            if not mutants:
+                continue
 
             # Evaluation (mutation, phenotype and evaluation)
+            # stopped as soon as the child cannot be better than the father,
+            # or of all the mutants at once
             t_ev_0 = time.time()
-            child_rv = evaluate(child_genome)
-            child_evaluation = child_rv['evaluation']
-            n_evaluations += 1
+            if len(mutants) > 1 and not self.child_evaluator:
+                children_rv = self.evaluate_batch([mutant[-1] for mutant in mutants])
+            else:
+                children_rv = [
+                    evaluate(mutant[-1], father_evaluation) for mutant in mutants]
+            n_evaluations += len(mutants)
             t_ev_tot += time.time() - t_ev_0
 
-            if child_evaluation < father_evaluation:
+            best_child = min(range(len(mutants)), key=lambda i: children_rv[i]['evaluation'])
+            if children_rv[best_child]['evaluation'] >= father_evaluation:
+                best_child = None
+            for i, ((mutation, mut_positions, key, child_genome), child_rv) in enumerate(zip(mutants, children_rv)):
+                if i == best_child:
+                    continue
+                child_evaluation = child_rv['evaluation']
+                failed_iterations += 1
+                # Improving children not chosen are not bad mutations
+                if child_evaluation >= father_evaluation and rejected is not None:
+                    rejected[key] = True
+                if mutation[0] == 'F' and child_evaluation >= father_evaluation:
+                    bad_flips.extend(mut_positions)
+                    if self.mutation_rates:
+                        self.mutation_rates.update(mut_positions, improved=False)
+
+                self.fitness_fail(mutation, father_evaluation, child_evaluation)
+                release(child_rv['phenotype'])
+
+            if best_child is not None:
+                mutation, mut_positions, key, child_genome = mutants[best_child]
+                child_rv = children_rv[best_child]
+                child_evaluation = child_rv['evaluation']
                 successful_iterations += 1
                 self.fitness_improved(mutation, father_evaluation, child_evaluation)
+                if mutation[0] == 'F':
+                    good_flips.extend(mut_positions)
 
+                father_phenotype = self.best['phenotype']
                 self.set_best(child_rv)
+                if drawn_father:
+                    release(father_phenotype)
+                drawn_father = True
                 father_evaluation = child_evaluation
                 father_genome = child_genome
 
-                # reset bad mutations
-                bad_mutations = set()
-            else:
-                failed_iterations += 1
-                if mutation[0] == 'F':
-                    if len(mut_positions) < 3:
-                        bad_mutations.add(mut_positions)
-                    self.bad_mutation_counter.update(mut_positions)
-
-                self.fitness_fail(mutation, father_evaluation, child_evaluation)
+        self.last_run_flips = (np.array(good_flips, np.uint32), np.array(bad_flips, np.uint32))
+        self.count_mutations(*self.last_run_flips)
 
-        t_ev_mean = t_ev_tot / n_evaluations
+        t_ev_mean = t_ev_tot / n_evaluations if n_evaluations else 0
         t_ev_avoided = t_ev_mean * n_skipped_evaluations
         self.t_saved = t_ev_avoided - t_sk_tot
 
@@ -168,3 +375,13 @@ class Island:
         print('Improvements/total = {:,}/{:,} ({:.01%})'.format(
             successful_iterations, self.run_iterations, successful_iterations / self.run_iterations))
         print('Island {} run: {:.2f} ({:.2f} it/s)'.format(self.short_id, t, self.run_iterations / t))
+        if rejected is not None:
+            n_mutants = n_evaluations + n_skipped_evaluations
+            print('Rejection cache: skipped {:,}/{:,} mutants ({:.1%}), t_saved = {:.3f}s'.format(
+                n_skipped_evaluations, n_mutants, n_skipped_evaluations / n_mutants if n_mutants else 0,
+                self.t_saved))
+        if self.layer_cache:
+            print(self.layer_cache.report())
+        for child_evaluator in self.child_evaluators:
+            if hasattr(child_evaluator, 'report'):
+                print(child_evaluator.report())
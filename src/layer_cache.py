@@ -0,0 +1,166 @@
+"""
+Prefix layer cache, to re-render only the layers changed by a mutation.
+
+Shapes are painted in a fixed order (after `symmetrify_shapes` sorts them),
+so a change to the k-th painted shape affects only the layers from k upward.
+The cache keeps the canvas of a reference drawing (the island father)
+every `every` painted layers, and children are painted starting from
+the nearest snapshot below their first changed layer.
+"""
+import numpy as np
+from PIL import Image
+
+from drawer import paint_shapes as pil_paint_shapes
+from drawer import symmetrify_shapes
+from rasterizer import fill_canvas, new_canvas
+from rasterizer import paint_shapes as numpy_paint_shapes
+from rasterizer import to_uint8
+
+
+def first_difference(shapes_a, shapes_b):
+    """
+    Return the index of the first different shape of two painted shapes lists,
+    or None if they are equal.
+    """
+    for i, (shape_a, shape_b) in enumerate(zip(shapes_a, shapes_b)):
+        if shape_a != shape_b:
+            return i
+    if len(shapes_a) != len(shapes_b):
+        return min(len(shapes_a), len(shapes_b))
+    return None
+
+
+class LayerCache:
+    """
+    Render sequences through `shapes_encoder`, starting from the snapshots
+    of the reference drawing (see `set_reference`).
+
+    It can be used in place of the encoder to decode, draw and render sequences.
+    """
+    def __init__(self, shapes_encoder, every=8):
+        self.shapes_encoder = shapes_encoder
+        self.every = every
+        self.reference = None  # genome
+        self.background = None
+        self.painted = []  # painted (symmetrified) shapes of the reference
+        self.snapshots = []  # canvas after 0, every, 2 * every, ... layers
+        # Stats
+        self.n_renders = 0
+        self.n_layers = 0  # layers painted
+        self.n_total_layers = 0  # layers of the rendered drawings
+
+    def __repr__(self):
+        return 'LayerCache(every={}, snapshots={})'.format(self.every, len(self.snapshots))
+
+    def decode(self, sequence):
+        return self.shapes_encoder.decode(sequence)
+
+    def decode_update(self, decoded, sequence, positions):
+        return self.shapes_encoder.decode_update(decoded, sequence, positions)
+
+    def dirty_box(self, decoded_a, decoded_b, records=None):
+        return self.shapes_encoder.dirty_box(decoded_a, decoded_b, records)
+
+    def draw(self, sequence):
+        return self.render(self.decode(sequence))
+
+    def release(self, phenotype):
+        self.shapes_encoder.release(phenotype)
+
+    def _new_canvas(self, background):
+        encoder = self.shapes_encoder
+        if encoder.renderer == 'numpy':
+            return new_canvas(encoder.image_size, background, len(encoder.image_mode))
+        return Image.new(encoder.image_mode, encoder.image_size, color=background)
+
+    def _paint(self, canvas, shapes):
+        encoder = self.shapes_encoder
+        paint = numpy_paint_shapes if encoder.renderer == 'numpy' else pil_paint_shapes
+        paint(canvas, shapes, encoder.shape, encoder.draw_image_mode)
+
+    def _canvas(self, background, snapshot):
+        """
+        Return a canvas to paint on: a copy of `snapshot`, if any,
+        else filled with `background`.
+        """
+        encoder = self.shapes_encoder
+        pool = encoder.canvas_pool
+        if not pool:
+            return self._new_canvas(background) if snapshot is None else snapshot.copy()
+        if encoder.renderer == 'numpy':
+            canvas = encoder.scratch_canvas()
+            if snapshot is None:
+                fill_canvas(canvas, background)
+            else:
+                np.copyto(canvas, snapshot)
+        else:
+            canvas = pool.acquire(encoder.new_canvas)
+            if snapshot is None:
+                canvas.paste(background, (0, 0) + canvas.size)
+            else:
+                canvas.paste(snapshot)
+        return canvas
+
+    def _output(self, canvas):
+        encoder = self.shapes_encoder
+        if encoder.renderer != 'numpy':
+            return encoder.mirrored(canvas)
+        out = encoder.canvas_pool.acquire(encoder.new_canvas) if encoder.canvas_pool else None
+        return encoder.mirrored(to_uint8(canvas, out))
+
+    def _start(self, background, painted):
+        """
+        Return the first layer to paint and the snapshot to start from (None to start from scratch).
+        """
+        if background != self.background or not self.snapshots:
+            return 0, None
+        first = first_difference(self.painted, painted)
+        if first is None:
+            first = len(painted)
+        index = min(first // self.every, len(self.snapshots) - 1)
+        return index * self.every, self.snapshots[index]
+
+    def render(self, decoded, scale=1):
+        """
+        Same as `ShapesEncoder.render`, painting only the layers
+        above the first one changed from the reference.
+        """
+        if scale != 1:
+            return self.shapes_encoder.render(decoded, scale)
+        encoder = self.shapes_encoder
+        painted = symmetrify_shapes(encoder.image_size, encoder.shapes_symmetry, decoded['shapes'])
+        start, snapshot = self._start(decoded['background'], painted)
+        canvas = self._canvas(decoded['background'], snapshot)
+        self._paint(canvas, painted[start:])
+        self.n_renders += 1
+        self.n_layers += len(painted) - start
+        self.n_total_layers += len(painted)
+        return self._output(canvas)
+
+    def set_reference(self, genome):
+        """
+        Take the snapshots of the drawing of `genome`, reusing the ones
+        below its first layer changed from the previous reference.
+        """
+        if genome == self.reference:
+            return
+        encoder = self.shapes_encoder
+        decoded = encoder.decode(genome)
+        painted = symmetrify_shapes(encoder.image_size, encoder.shapes_symmetry, decoded['shapes'])
+        start, snapshot = self._start(decoded['background'], painted)
+        canvas = self._new_canvas(decoded['background']) if snapshot is None else snapshot.copy()
+        snapshots = self.snapshots[: start // self.every] if start else []
+        for layer in range(start, len(painted) + 1, self.every):
+            if layer > start:
+                self._paint(canvas, painted[layer - self.every: layer])
+            snapshots.append(canvas.copy())
+        self.reference = genome
+        self.background = decoded['background']
+        self.painted = painted
+        self.snapshots = snapshots
+
+    def report(self):
+        return 'Layer cache: painted {:,}/{:,} layers ({:.1%}) in {:,} renders'.format(
+            self.n_layers, self.n_total_layers,
+            self.n_layers / self.n_total_layers if self.n_total_layers else 0, self.n_renders,
+        )
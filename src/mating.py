@@ -6,9 +6,15 @@ from operator import itemgetter
 from random import shuffle
 
 import crossover
+from genome import PackedGenome, join_bases, to_packed
 
 
-def mate(islands, evaluate, f1_size, f2_size, n_crossovers=1):
+def mate(islands, evaluate_batch, f1_size, f2_size, n_crossovers=1):
+    """
+    Recombinate islands bests and return the best evaluated offspring.
+
+    :param evaluate_batch: function which evaluates a list of genomes at once
+    """
     parent_genomes = [isla.best['genome'] for isla in islands]
     f1_offsprings = get_offsprings(
         parent_genomes,
@@ -22,7 +28,7 @@ def mate(islands, evaluate, f1_size, f2_size, n_crossovers=1):
     print('f2: {:,}'.format(len(f2_offsprings)))
     offsprings = f1_offsprings + f2_offsprings
 
-    ev_offsprings = [evaluate(genome) for genome in offsprings]
+    ev_offsprings = evaluate_batch(offsprings)
     ev_offsprings.sort(key=itemgetter('evaluation'))
     for ev_offspring in ev_offsprings:
         if ev_offspring['genome'] not in parent_genomes:
@@ -49,9 +55,13 @@ def get_offsprings(parents, n_max_offsprings=64, n_crossovers=1):
             crossover_points = ()
             while not crossover_points:
                 crossover_points = crossover.normal_rand_crossover_operator(p_a, p_b)
-            for offspring in [
-                ''.join(c) for c in crossover.crossover(p_a, p_b, crossover_points)
-                ]:
+            if isinstance(p_a, PackedGenome):
+                # Exchange whole regions of the bits arrays
+                children = [PackedGenome.from_bits(c) for c in crossover.crossover(
+                    to_packed(p_a).bits(), to_packed(p_b).bits(), crossover_points)]
+            else:
+                children = [join_bases(c) for c in crossover.crossover(p_a, p_b, crossover_points)]
+            for offspring in children:
                 if offspring not in parents:
                     offsprings.append(offspring)
         # avoid explosion of combinations
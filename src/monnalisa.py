@@ -4,6 +4,7 @@ Disegna a caso.
 * isole
 * multiprocessing
 """
+import atexit
 import os
 import time
 from collections import Counter
@@ -11,18 +12,20 @@ from functools import partial
 from operator import attrgetter
 from multiprocessing import Pool, cpu_count
 
-from imageio import mimwrite
+from imageio import mimread, mimwrite
 from numpy import asarray
+from numpy.random import default_rng
 
 import cli
-from drawer import draw_as_svg
-from evaluator import ImageEvaluator, func_evaluate
-from genome import genetic_distances, opposite_genome
+from drawer import as_image, draw_as_svg
+from evaluator import CachedEvaluator, ImageEvaluator, func_evaluate, func_evaluate_batch, with_phenotype
+from genome import distances_to, genetic_distances, opposite_genome
 from history import HistoryIO
 from island import Island
 from mating import mate
 from shapes_encoder import ShapesEncoder
 from utils import AccumulativeMean
+from workers import IslandWorkers
 
 p_join = os.path.join
 
@@ -53,6 +56,15 @@ def parallelislands(islands, processes):
     return islands, i_elapsed
 
 
+def read_frames(path, ndim):
+    """
+    Return the frames of the gif animation at `path`, if any, with `ndim` dimensions.
+    """
+    if not os.path.exists(path):
+        return []
+    return [frame if frame.ndim == ndim else frame[..., 0] for frame in mimread(path)]
+
+
 def optimize_processes(processes, time_per_processes, count_threshold, max_processes):
     """Return number of processes based on `time_per_processes` means.
 
@@ -76,21 +88,35 @@ def optimize_processes(processes, time_per_processes, count_threshold, max_proce
 
 
 def generate_islands(options, shapes_encoder, im_eval):
+    island_kwargs = dict(
+        run_iterations=options.crossover_freq,
+        p_transposition_replicative=options.p_transposition_replicative,
+        incremental=options.incremental,
+        prescreen_margin=options.prescreen_margin if options.prescreen_levels else None,
+        sampled=bool(options.sample_fraction),
+        cache_size=options.cache_size,
+        layer_cache=options.layer_cache,
+        packed=options.packed,
+        p_position=options.p_position,
+        n_mutants=options.n_mutants,
+        rejection_cache=options.rejection_cache,
+    )
+    # One random genome for each pair of complementary islands
+    adams = shapes_encoder.generate_many(
+        (options.n_islands + 1) // 2, rng=default_rng(options.seed), packed=options.packed)
     rv = []
     while len(rv) < options.n_islands:
         isola = Island(
             len(rv), shapes_encoder, im_eval,
-            run_iterations=options.crossover_freq, k_mut=0.5 * (len(rv) + 1),
-            p_transposition_replicative=options.p_transposition_replicative,
+            genome=adams[len(rv) // 2],
+            k_mut=0.5 * (len(rv) + 1), **island_kwargs
         )
         rv.append(isola)
         if len(rv) < options.n_islands:
-            # FIXME: Warning, almost duplicated code
             complentary = Island(
                 len(rv), shapes_encoder, im_eval,
                 genome=opposite_genome(isola.adam),
-                run_iterations=options.crossover_freq, k_mut=0.5 * (len(rv) + 1),
-                p_transposition_replicative=options.p_transposition_replicative,
+                k_mut=0.5 * (len(rv) + 1), **island_kwargs
             )
             rv.append(complentary)
     return tuple(rv)
@@ -106,7 +132,12 @@ def main(options):
     print('target: {}'.format(repr(options.target)))
     print('drawing {} with {} polygons'.format(options.target, n_shapes))
 
-    im_eval = ImageEvaluator(options.target, dst_image_mode=options.target_image_mode, resize=options.resize)
+    im_eval = ImageEvaluator(
+        options.target, dst_image_mode=options.target_image_mode, resize=options.resize,
+        pyramid_levels=options.prescreen_levels,
+        sample_fraction=options.sample_fraction, sample_sets=options.sample_sets,
+        fold_symmetry=options.symmetry if options.mirror else '',
+    )
     image_size = im_eval.target_size
 
     shapes_encoder = ShapesEncoder(
@@ -116,9 +147,17 @@ def main(options):
         shape=options.shape,
         n_shapes=n_shapes,
         symmetry=options.symmetry,
+        renderer=options.renderer,
+        canvas_pool=options.canvas_pool,
+        mirror=options.mirror,
     )
     print('Genome length: {:,}'.format(shapes_encoder.genome_size))
-    evaluate = partial(func_evaluate, shapes_encoder, im_eval)
+    evaluate_batch = partial(func_evaluate_batch, shapes_encoder, im_eval)
+    crossover_cache = None
+    if options.cache_size:
+        crossover_cache = CachedEvaluator(
+            partial(func_evaluate, shapes_encoder, im_eval), options.cache_size, evaluate_batch)
+        evaluate_batch = crossover_cache.batch
 
     islands = generate_islands(options, shapes_encoder, im_eval)
     best_ev_offspring = islands[0].best  # arbitrary individual
@@ -146,6 +185,12 @@ def main(options):
 
     print('{} islands: {}'.format(len(islands), islands))
 
+    if options.shared_target:
+        # Resumed islands bring their own evaluator
+        for evaluator in {id(isla.evaluator): isla.evaluator for isla in islands}.values():
+            evaluator.share()
+            atexit.register(evaluator.unlink)
+
     # Deciding number of processes to run islands
     max_processes = min(len(islands) * 2, cpu_count())
     count_threshold = 3
@@ -154,84 +199,109 @@ def main(options):
     for n in range(1, max_processes + 1):
         time_per_processes[n] = AccumulativeMean(round_digits=1)
 
+    workers = None
+    if options.persistent_workers:
+        # Islands resident in the workers for the whole session
+        processes = processes or min(len(islands), cpu_count())
+        workers = IslandWorkers(islands, processes)
+
     animation = []  # store frames for gif animation
+    islands_animation = {}  # frames of the islands gif animations, by island index
     t_0 = time.time()
     total_session_iterations = 0
-    while True:
-        processes = options.processes if options.processes else \
-            optimize_processes(processes, time_per_processes, count_threshold, max_processes)
-        print('Running {i} island{s} across {p} process{es}'.format(
-            i=len(islands), s=(len(islands) > 1) * 's', p=processes, es=(processes > 1) * 'es')
-        )
-        # =============================================
-        # ------------------ ISLANDS ------------------
-        # =============================================
-        islands, run_speed = parallelislands(islands, processes)
-        time_per_processes[processes] += run_speed
-
-        for i, isla in enumerate(sorted(islands, key=attrgetter('best_evaluation'))):
-            delta = isla.run_delta_evaluation
-            print('#{rank} - i{i} it: {it:,}, gl: {gl:,}, v = {ev:,} ({d:,})'.format(
-                rank=i, i=isla.index, it=isla.iteration, gl=len(isla.best['genome']),
-                ev=isla.best['evaluation'], d=delta)
+    try:
+        while True:
+            if not workers:
+                processes = options.processes if options.processes else \
+                    optimize_processes(processes, time_per_processes, count_threshold, max_processes)
+            print('Running {i} island{s} across {p} process{es}'.format(
+                i=len(islands), s=(len(islands) > 1) * 's', p=processes, es=(processes > 1) * 'es')
             )
-
-            if delta < 0:
-                isla_best_dst = p_join(history_io.dirpath, 'best-island-{}-{}.png'.format(isla.index, isla.id[:7]))
-                isla.best['phenotype'].save(isla_best_dst)
-
-                isla.animation_frames.append(asarray(isla.best['phenotype'], order='F'))
-                mimwrite(isla_best_dst + '.gif', isla.animation_frames)
-
-        islands_best_ev = [isla.best_evaluation for isla in islands]
-        islands_genomes = [isla.best['genome'] for isla in islands]
-        gen_diffs = genetic_distances(*islands_genomes)
-        print('Variab gen (mean) = {:.3f}'.format(sum(gen_diffs) / len(islands)))
-
-        # =============================================
-        # ---------------- CROSSOVER ------------------
-        # =============================================
-        new_best_ev_offspring = mate(
-            islands, evaluate,
-            f1_size=options.f1,
-            f2_size=options.f2,
-            n_crossovers=options.n_crossovers,
-        )
-        if new_best_ev_offspring['evaluation'] < best_ev_offspring['evaluation']:
-            print('New best crossover! ev = {:,}'.format(new_best_ev_offspring['evaluation']))
-            best_crossover_dst = p_join(history_io.dirpath, 'best-crossover.png')
-            new_best_ev_offspring['phenotype'].save(best_crossover_dst)
-            best_ev_offspring = new_best_ev_offspring
-            image_array = asarray(new_best_ev_offspring['phenotype'], order='F')
-            animation.append(image_array)
-            mimwrite(p_join(history_io.dirpath, 'best_crossover.gif'), animation)
-
-        if best_ev_offspring['evaluation'] < min(islands_best_ev):
-            print('crossover is currently the best: {:,}'.format(best_ev_offspring['evaluation']))
-        co_genome = best_ev_offspring['genome']
-
-        # TODO: refactor
-        decoded = isla.shapes_encoder.decode(co_genome)
-        draw_as_svg(p_join(history_io.dirpath, 'best_crossover.svg'),
-                    image_size=image_size,
-                    shapes=decoded['shapes'], shape=options.shape,
-                    background_color=decoded['background'],
-                    dst_image_mode=options.target_image_mode, draw_image_mode=options.draw_image_mode,
-                    symmetry=options.symmetry)
-
-        genetic_dist = [genetic_distances(co_genome, g)[0] for g in islands_genomes]
-        for i_isla, distance in enumerate(genetic_dist):
-            print('distance best-crossover vs island {}: {:.3f}'.format(i_isla, distance))
-
-        status = {'islands': islands, 'best_ev_offspring': best_ev_offspring}
-        history_io.save(status)
-        history_io.update_stats(status, plot=True)
-        history_io.update_genomes_stuff(status, save_good_mutations=True)
-
-        elapsed = time.time() - t_0
-        total_session_iterations += (options.crossover_freq * len(islands))
-        speed = total_session_iterations / elapsed
-        print('Session mean speed: {:.2f} it/s'.format(speed))
+            # =============================================
+            # ------------------ ISLANDS ------------------
+            # =============================================
+            if workers:
+                islands, run_speed = workers.run(islands)
+            else:
+                islands, run_speed = parallelislands(islands, processes)
+                time_per_processes[processes] += run_speed
+
+            for i, isla in enumerate(sorted(islands, key=attrgetter('best_evaluation'))):
+                delta = isla.run_delta_evaluation
+                print('#{rank} - i{i} it: {it:,}, gl: {gl:,}, v = {ev:,} ({d:,})'.format(
+                    rank=i, i=isla.index, it=isla.iteration, gl=len(isla.best['genome']),
+                    ev=isla.best['evaluation'], d=delta)
+                )
+
+                if delta < 0:
+                    isla.best = with_phenotype(isla.shapes_encoder, isla.best)
+                    isla_best_dst = p_join(history_io.dirpath, 'best-island-{}-{}.png'.format(isla.index, isla.id[:7]))
+                    isla_best_image = as_image(isla.best['phenotype'])
+                    isla_best_image.save(isla_best_dst)
+
+                    frame = asarray(isla_best_image, order='F')
+                    if isla.index not in islands_animation:
+                        # Frames of the previous sessions
+                        islands_animation[isla.index] = read_frames(isla_best_dst + '.gif', frame.ndim)
+                    islands_animation[isla.index].append(frame)
+                    mimwrite(isla_best_dst + '.gif', islands_animation[isla.index])
+
+            islands_best_ev = [isla.best_evaluation for isla in islands]
+            islands_genomes = [isla.best['genome'] for isla in islands]
+            gen_diffs = genetic_distances(*islands_genomes)
+            print('Variab gen (mean) = {:.3f}'.format(sum(gen_diffs) / len(islands)))
+
+            # =============================================
+            # ---------------- CROSSOVER ------------------
+            # =============================================
+            new_best_ev_offspring = mate(
+                islands, evaluate_batch,
+                f1_size=options.f1,
+                f2_size=options.f2,
+                n_crossovers=options.n_crossovers,
+            )
+            new_best_ev_offspring = with_phenotype(shapes_encoder, new_best_ev_offspring)
+            if crossover_cache:
+                print('Crossover {}'.format(crossover_cache.report()))
+            if new_best_ev_offspring['evaluation'] < best_ev_offspring['evaluation']:
+                print('New best crossover! ev = {:,}'.format(new_best_ev_offspring['evaluation']))
+                best_crossover_dst = p_join(history_io.dirpath, 'best-crossover.png')
+                best_crossover_image = as_image(new_best_ev_offspring['phenotype'])
+                best_crossover_image.save(best_crossover_dst)
+                best_ev_offspring = new_best_ev_offspring
+                image_array = asarray(best_crossover_image, order='F')
+                animation.append(image_array)
+                mimwrite(p_join(history_io.dirpath, 'best_crossover.gif'), animation)
+
+            if best_ev_offspring['evaluation'] < min(islands_best_ev):
+                print('crossover is currently the best: {:,}'.format(best_ev_offspring['evaluation']))
+            co_genome = best_ev_offspring['genome']
+
+            # TODO: refactor
+            decoded = isla.shapes_encoder.decode(co_genome)
+            draw_as_svg(p_join(history_io.dirpath, 'best_crossover.svg'),
+                        image_size=image_size,
+                        shapes=decoded['shapes'], shape=options.shape,
+                        background_color=decoded['background'],
+                        dst_image_mode=options.target_image_mode, draw_image_mode=options.draw_image_mode,
+                        symmetry=options.symmetry, mirror=options.mirror)
+
+            genetic_dist = distances_to(co_genome, islands_genomes).tolist()
+            for i_isla, distance in enumerate(genetic_dist):
+                print('distance best-crossover vs island {}: {:.3f}'.format(i_isla, distance))
+
+            status = {'islands': islands, 'best_ev_offspring': best_ev_offspring}
+            history_io.save(status)
+            history_io.update_stats(status, plot=True)
+            history_io.update_genomes_stuff(status, save_good_mutations=True, save_mutation_counts=True)
+
+            elapsed = time.time() - t_0
+            total_session_iterations += (options.crossover_freq * len(islands))
+            speed = total_session_iterations / elapsed
+            print('Session mean speed: {:.2f} it/s'.format(speed))
+    finally:
+        if workers:
+            workers.close()
 
 
 if __name__ == '__main__':
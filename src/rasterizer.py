@@ -0,0 +1,278 @@
+"""
+Pure NumPy shapes rasterizer, alternative to the Pillow drawer.
+
+Shapes are rasterized sampling the pixel centers of their bounding box
+and alpha composited into a float32 canvas. The canvas is planar,
+(channels, height, width), since compositing each plane is much faster
+than broadcasting over interleaved channels.
+"""
+from functools import lru_cache
+
+import numpy as np
+from PIL import ImageColor
+
+from drawer import CIRCLE_SIZE, Shape, symmetrify_shapes
+
+# Supported destination image modes and, for each one, the drawing modes
+SUPPORTED_MODES = {
+    'L': ('L', 'LA'),
+    'RGB': ('RGB', 'RGBA'),
+}
+
+
+def check_modes(dst_image_mode, draw_image_mode):
+    """
+    Raise ValueError if the image modes are not supported by the rasterizer.
+    """
+    if draw_image_mode not in SUPPORTED_MODES.get(dst_image_mode, ()):
+        raise ValueError('Unsupported image modes for the numpy rasterizer: {} drawn in {}'.format(
+            dst_image_mode, draw_image_mode))
+
+
+def new_canvas(image_size, background_color, channels):
+    """
+    Return a new float32 canvas filled with `background_color`.
+    """
+    width, height = image_size
+    return fill_canvas(np.empty((channels, height, width), np.float32), background_color)
+
+
+def fill_canvas(canvas, background_color):
+    """
+    Fill a float `canvas` with `background_color`.
+    """
+    if isinstance(background_color, str):
+        background_color = ImageColor.getrgb(background_color)
+    channels = len(canvas)
+    canvas[...] = np.reshape(background_color[:channels], (channels, 1, 1))
+    return canvas
+
+
+def to_uint8(canvas, out=None):
+    """
+    Round a float canvas to an uint8 array (height, width, channels).
+
+    If `out` is given, the result is written there, using `canvas` as buffer
+    (so it is modified).
+    """
+    if out is None:
+        return (np.moveaxis(canvas, 0, -1) + 0.5).astype(np.uint8)
+    canvas += 0.5
+    np.copyto(out, np.moveaxis(canvas, 0, -1), casting='unsafe')
+    return out
+
+
+def _box(points, width, height, margin=0):
+    """
+    Return the (left, upper, right, lower) box of the pixels covered by `points`,
+    clipped to the canvas, or None if it is empty.
+    """
+    xs = [x for x, y in points]
+    ys = [y for x, y in points]
+    left = max(int(np.floor(min(xs) - margin)), 0)
+    upper = max(int(np.floor(min(ys) - margin)), 0)
+    right = min(int(np.ceil(max(xs) + margin)) + 1, width)
+    lower = min(int(np.ceil(max(ys) + margin)) + 1, height)
+    if left >= right or upper >= lower:
+        return None
+    return left, upper, right, lower
+
+
+def _centers(box):
+    """
+    Return the x (as a row) and y (as a column) coordinates of the pixel centers of `box`.
+    """
+    left, upper, right, lower = box
+    xs = np.arange(left, right, dtype=np.float32)[np.newaxis, :] + 0.5
+    ys = np.arange(upper, lower, dtype=np.float32)[:, np.newaxis] + 0.5
+    return xs, ys
+
+
+def triangle_mask(p0, p1, p2, xs, ys):
+    """
+    Return the boolean mask of the pixel centers (`xs`, `ys`) inside the triangle.
+
+    Centers lying exactly on an edge are assigned only to one of the two
+    triangles sharing it, so that adjacent triangles do not overlap.
+    """
+    (ax, ay), (bx, by), (cx, cy) = p0, p1, p2
+    area = (bx - ax) * (cy - ay) - (by - ay) * (cx - ax)
+    if area == 0:
+        return np.zeros(np.broadcast(xs, ys).shape, bool)
+    if area < 0:
+        (bx, by), (cx, cy) = (cx, cy), (bx, by)
+    mask = None
+    for (x0, y0), (x1, y1) in (((ax, ay), (bx, by)), ((bx, by), (cx, cy)), ((cx, cy), (ax, ay))):
+        dx = x1 - x0
+        dy = y1 - y0
+        # The edge function dx * (y - y0) - dy * (x - x0) is >= 0 (or > 0) inside:
+        # compare its y (column) and x (row) terms, without summing them
+        y_term = dx * (ys - y0)
+        x_term = dy * (xs - x0)
+        inside = y_term >= x_term if (dy < 0 or (dy == 0 and dx > 0)) else y_term > x_term
+        mask = inside if mask is None else mask & inside
+    return mask
+
+
+def polygon_mask(points, xs, ys):
+    """
+    Return the boolean mask of the pixel centers (`xs`, `ys`) inside the polygon,
+    with the even-odd rule (as a xor of the triangles fanning from the first point).
+    """
+    mask = triangle_mask(points[0], points[1], points[2], xs, ys)
+    for i in range(2, len(points) - 1):
+        mask ^= triangle_mask(points[0], points[i], points[i + 1], xs, ys)
+    return mask
+
+
+def ellipse_mask(box, xs, ys):
+    """
+    Return the boolean mask of the pixel centers (`xs`, `ys`) inside the ellipse
+    inscribed in the (inclusive) `box`.
+    """
+    x0, y0, x1, y1 = box
+    x0, x1 = sorted((x0, x1))
+    y0, y1 = sorted((y0, y1))
+    rx = (x1 - x0 + 1) / 2
+    ry = (y1 - y0 + 1) / 2
+    return ((xs - x0 - rx) / rx) ** 2 + ((ys - y0 - ry) / ry) ** 2 <= 1
+
+
+def line_mask(p0, p1, line_width, xs, ys):
+    """
+    Return the boolean mask of the pixel centers (`xs`, `ys`) closer
+    than half `line_width` to the segment.
+    """
+    (ax, ay), (bx, by) = p0, p1
+    dx = bx - ax
+    dy = by - ay
+    length2 = dx * dx + dy * dy
+    px = xs - ax - 0.5
+    py = ys - ay - 0.5
+    if length2:
+        t = np.clip((px * dx + py * dy) / length2, 0, 1)
+        px = px - t * dx
+        py = py - t * dy
+    half = max(line_width, 1) / 2
+    return px * px + py * py <= half * half
+
+
+def composite(canvas, box, mask, color, alpha):
+    """
+    Blend `color` with opacity `alpha` (0 - 1) into the `box` of `canvas`, where `mask` is True.
+    """
+    left, upper, right, lower = box
+    region = canvas[:, upper: lower, left: right]
+    # Weighting the whole region is faster than boolean indexing
+    diff = np.reshape(np.asarray(color, np.float32), (-1, 1, 1)) - region
+    diff *= mask * np.float32(min(alpha, 1))
+    region += diff
+
+
+@lru_cache(maxsize=None)
+def circle_sprite():
+    """
+    Return the float32 mask of a circle painted at (0, 0), at scale 1.
+    """
+    size = CIRCLE_SIZE + 1
+    xs, ys = _centers((0, 0, size, size))
+    return ellipse_mask((0, 0, CIRCLE_SIZE, CIRCLE_SIZE), xs, ys).astype(np.float32)
+
+
+def stamp_circles(canvas, shapes, draw_image_mode='RGBA'):
+    """
+    Paint circle `shapes` on a float `canvas` (at scale 1), stamping
+    the circle sprite clipped at the canvas borders.
+    """
+    if not shapes:
+        return canvas
+    channels, height, width = canvas.shape
+    sprite = circle_sprite()
+    size = len(sprite)
+    # Sprites weighted by the circles opacity, and boxes, all at once
+    colors = np.array([color for color, points, extra in shapes])
+    if draw_image_mode.endswith('A'):
+        alphas = np.minimum(colors[:, -1] / 255, 1).astype(np.float32)
+    else:
+        alphas = np.ones(len(shapes), np.float32)
+    masks = sprite * alphas[:, np.newaxis, np.newaxis]
+    colors = colors[:, :channels].astype(np.float32)[:, :, np.newaxis, np.newaxis]
+    corners = np.array([points[0] for color, points, extra in shapes])
+    lefts = np.maximum(corners[:, 0], 0).tolist()
+    uppers = np.maximum(corners[:, 1], 0).tolist()
+    rights = np.minimum(corners[:, 0] + size, width).tolist()
+    lowers = np.minimum(corners[:, 1] + size, height).tolist()
+    for i, (x, y) in enumerate(corners.tolist()):
+        left, upper, right, lower = lefts[i], uppers[i], rights[i], lowers[i]
+        if left >= right or upper >= lower:
+            continue
+        region = canvas[:, upper: lower, left: right]
+        diff = colors[i] - region
+        diff *= masks[i, upper - y: lower - y, left - x: right - x]
+        region += diff
+    return canvas
+
+
+def paint_shapes(canvas, shapes, shape, draw_image_mode='RGBA', scale=1):
+    """
+    Paint `shapes` (color, points, extra), in order, on a float `canvas`.
+    """
+    if shape is Shape.CIRCLE and scale == 1:
+        return stamp_circles(canvas, shapes, draw_image_mode)
+    channels, height, width = canvas.shape
+    has_alpha = draw_image_mode.endswith('A')
+    circle_size = CIRCLE_SIZE * scale
+    for color, points, extra in shapes:
+        if scale != 1:
+            points = [(x * scale, y * scale) for (x, y) in points]
+            extra = extra and int(extra * scale)
+        if shape is Shape.CIRCLE:
+            (x, y), = points
+            points = [(x, y), (x + circle_size, y + circle_size)]
+
+        margin = max(extra, 1) / 2 if shape is Shape.LINE else 0
+        box = _box(points, width, height, margin)
+        if box is None:
+            continue
+        xs, ys = _centers(box)
+        if shape in (Shape.CIRCLE, Shape.ELLIPSE):
+            mask = ellipse_mask(points[0] + points[1], xs, ys)
+        elif shape is Shape.LINE:
+            mask = line_mask(points[0], points[1], extra, xs, ys)
+        elif shape is Shape.RECT:
+            (x0, y0), (x1, y1) = points
+            mask = (xs >= min(x0, x1)) & (xs < max(x0, x1) + 1) & (ys >= min(y0, y1)) & (ys < max(y0, y1) + 1)
+        else:
+            mask = polygon_mask(points, xs, ys)
+
+        alpha = color[-1] / 255 if has_alpha else 1
+        composite(canvas, box, mask, color[:channels], alpha)
+    return canvas
+
+
+def rasterize_shapes(
+        image_size, shapes, shape,
+        background_color='white',
+        dst_image_mode='RGB',
+        draw_image_mode='RGBA',
+        symmetry='',
+        scale=1,
+        out=None,
+        canvas=None,
+    ):
+    """
+    Same as `drawer.draw_shapes`, but return an uint8 array (height, width, channels)
+    drawn with the numpy rasterizer.
+
+    If given, the result is written in the `out` array, and the float `canvas`
+    (see `new_canvas`) is used to draw.
+    """
+    width, height = image_size
+    if canvas is None:
+        canvas = new_canvas(
+            (int(width * scale), int(height * scale)), background_color, len(dst_image_mode))
+    else:
+        fill_canvas(canvas, background_color)
+    total_shapes = symmetrify_shapes(image_size, symmetry, shapes)
+    paint_shapes(canvas, total_shapes, shape, draw_image_mode, scale)
+    return to_uint8(canvas, out)
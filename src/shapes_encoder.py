@@ -1,9 +1,18 @@
 from math import ceil, log
-from random import choice
+import numpy as np
+from PIL import Image
 
-from drawer import Shape, IMAGE_MODES, POINTS_PER_SHAPE, EXTRA_BITS_PER_SHAPE, draw_shapes
+from drawer import (
+    Shape, IMAGE_MODES, POINTS_PER_SHAPE, EXTRA_BITS_PER_SHAPE,
+    CanvasPool, changed_shapes, draw_shapes, mirror_image, mirror_pixels, shapes_box,
+)
+from genome import PackedGenome, genome_bits, random_bits, to_string
+from rasterizer import check_modes, new_canvas, rasterize_shapes
 
-BASES = '01'
+RENDERERS = {
+    'pil': draw_shapes,  # draw Pillow images
+    'numpy': rasterize_shapes,  # draw uint8 numpy arrays
+}
 
 
 class ShapesEncoder:
@@ -19,6 +28,9 @@ class ShapesEncoder:
             n_shapes=32,
             color_bit_depth=8,
             symmetry='',
+            renderer='pil',
+            canvas_pool=0,
+            mirror=False,
         ):
         print('ShapesEncoder init with image_mode={}'.format(image_mode))
         self.image_size = image_size
@@ -28,6 +40,16 @@ class ShapesEncoder:
         self.draw_image_mode = draw_image_mode
         self.color_channels = len(draw_image_mode)
         self.symmetry = symmetry
+        # Draw the symmetry mirroring the pixels of the fundamental domain,
+        # instead of duplicating the shapes
+        self.mirror = bool(mirror and symmetry)
+        self.shapes_symmetry = '' if self.mirror else symmetry
+        assert renderer in RENDERERS, 'Invalid renderer: {}'.format(renderer)
+        if renderer == 'numpy':
+            check_modes(image_mode, draw_image_mode)
+        self.renderer = renderer
+        # Reuse the released images (see `release`), up to this many
+        self.canvas_pool = CanvasPool(canvas_pool) if canvas_pool else None
         self.bg_warned = False
         # TODO: refactor shape e n_shapes in a single attribute
         self.shape = Shape(shape)
@@ -54,6 +76,34 @@ class ShapesEncoder:
         print('self.bits =', self.bits)
         self.index = 0
 
+        # Bit layout of each shape record: (field, offset in the record, width)
+        fields = [('visible', visible_bits), ('position_x', size_bits[0]), ('position_y', size_bits[1])]
+        for i in range(points_per_shape):
+            fields += [('point{}_x'.format(i), size_bits[0]), ('point{}_y'.format(i), size_bits[1])]
+        fields += [('color{}'.format(i), self.bits['channel']) for i in range(self.color_channels)]
+        if extra:
+            fields.append(('extra', extra))
+        self.layout = []
+        offset = 0
+        for name, n_bits in fields:
+            self.layout.append((name, offset, n_bits))
+            offset += n_bits
+        self.record_bits = offset
+        # Records can be decoded all at once only if every field has some bits
+        self.vectorized = min(n_bits for name, offset, n_bits in self.layout) > 0
+        self.background_bits = color_bits
+        self.channel_weights = 2 ** np.arange(self.bits['channel'] - 1, -1, -1)
+        # Visibility bit of every (even truncated) record
+        self.visibility_positions = np.arange(self.background_bits, self.genome_size, self.record_bits)
+        # Weights of the record bits, to decode all the fields of all the records at once
+        self.field_weights = np.zeros((self.record_bits, len(self.layout)))
+        for column, (name, offset, n_bits) in enumerate(self.layout):
+            self.field_weights[offset: offset + n_bits, column] = 2 ** np.arange(n_bits - 1, -1, -1)
+        # Index of the field of each record position (see `locate`)
+        self.record_fields = np.zeros(self.record_bits, np.int64)
+        for column, (name, offset, n_bits) in enumerate(self.layout):
+            self.record_fields[offset: offset + n_bits] = column
+
     def _read(self, sequence, n_bits):
         """
         Read and decode a `sequence` chunk of `n_bits` in decimal.
@@ -87,10 +137,182 @@ class ShapesEncoder:
                 for _ in range(self.color_channels)]
         )
 
+    def _read_record(self, sequence):
+        """
+        Read and decode the values of the fields of a shape record (see `layout`).
+        """
+        return [self._read(sequence, n_bits) for name, offset, n_bits in self.layout]
+
+    def _read_background(self, sequence, bits):
+        """
+        Decode the background color from the `bits` of `sequence`.
+        """
+        if len(bits) < self.background_bits:
+            # Truncated color, read field by field
+            self.index = 0
+            return self._read_color(to_string(sequence))
+        self.index = self.background_bits
+        color = bits[: self.background_bits].reshape(self.color_channels, -1) @ self.channel_weights
+        return tuple(color.tolist())
+
+    def decode_arrays(self, sequence):
+        """
+        Translate a binary `sequence` (string or packed) into arrays,
+        one row for each shape record: visibility mask, (absolute) points,
+        colors and extra values (None if the shape has no extra bits).
+
+        Also return the background color and the record start positions.
+        """
+        bits = genome_bits(sequence)
+        background = self._read_background(sequence, bits)
+        starts = []
+        # Complete records are decoded all at once
+        n_records = 0
+        if self.vectorized:
+            n_records = (len(sequence) - self.index) // self.record_bits
+            stop = self.index + n_records * self.record_bits
+            records = bits[self.index: stop].reshape(n_records, self.record_bits)
+            values = (records @ self.field_weights).astype(np.int64)
+            starts = list(range(self.index, stop, self.record_bits))
+            self.index = stop
+        else:
+            values = np.zeros((0, len(self.layout)), np.int64)
+        # A trailing truncated record is read field by field (as long as every field has some bits)
+        tail = []
+        if self.index < len(sequence):
+            sequence = to_string(sequence)
+        while self.index < len(sequence):
+            starts.append(self.index)
+            try:
+                tail.append(self._read_record(sequence))
+            except ValueError:
+                break
+        if tail:
+            values = np.concatenate([values, np.array(tail, np.int64)])
+
+        return dict(self._record_arrays(values), background=background, starts=starts)
+
+    def _record_arrays(self, values):
+        """
+        Return the arrays of the shapes of the records with field `values` (see `decode_arrays`).
+        """
+        points_per_shape = POINTS_PER_SHAPE[self.shape]
+        points = values[:, 3: 3 + 2 * points_per_shape].reshape(-1, points_per_shape, 2)
+        points += values[:, np.newaxis, 1: 3]
+        color_start = 3 + 2 * points_per_shape
+        return {
+            'visible': values[:, 0] != 0,
+            'points': points,
+            'colors': values[:, color_start: color_start + self.color_channels],
+            'extra': values[:, -1] if self.bits['extra'] else None,
+        }
+
     def decode(self, sequence):
         """
         Translate a binary `sequence` into an high level drawing information.
         """
+        arrays = self.decode_arrays(sequence)
+        return {'background': arrays['background'], 'shapes': self.visible_shapes(arrays),
+                'annotations': {'visibility': arrays['starts']}, 'arrays': arrays}
+
+    def locate(self, positions):
+        """
+        Return the record (shape) indices and the field names of the genome `positions`,
+        record -1 and field 'background' for the background color.
+        """
+        positions = np.asarray(positions, np.int64) - self.background_bits
+        records, offsets = np.divmod(positions, self.record_bits)
+        fields = [self.layout[column][0] for column in self.record_fields[offsets].tolist()]
+        is_background = positions < 0
+        records[is_background] = -1
+        return records, [
+            'background' if background else field for field, background in zip(fields, is_background.tolist())
+        ]
+
+    def decode_update(self, decoded, sequence, positions):
+        """
+        Return the decoded `sequence`, which differs from the `decoded` one only
+        in `positions`, decoding again only the shape records they touch.
+
+        Also return the indices of the records whose shapes changed
+        (visible before or after the change).
+        """
+        arrays = decoded['arrays']
+        background_bits = self.background_bits
+        records = sorted({
+            (position - background_bits) // self.record_bits
+            for position in positions if position >= background_bits
+        })
+        n_complete = (len(sequence) - background_bits) // self.record_bits
+        if records and (records[-1] >= n_complete or not self.vectorized):
+            # Truncated records are read field by field
+            decoded = self.decode(sequence)
+            return decoded, [record for record in records if record < len(decoded['arrays']['visible'])]
+
+        bits = genome_bits(sequence)
+        background = decoded['background']
+        if len(positions) and min(positions) < background_bits:
+            background = self._read_background(sequence, bits)
+        if not records:
+            return dict(decoded, background=background, arrays=dict(arrays, background=background)), []
+
+        starts = background_bits + np.array(records) * self.record_bits
+        record_bits = bits[starts[:, np.newaxis] + np.arange(self.record_bits)]
+        values = (record_bits @ self.field_weights).astype(np.int64)
+        updated = self._record_arrays(values)
+        new_arrays = dict(arrays, background=background)
+        for key, array in updated.items():
+            if array is not None:
+                new_arrays[key] = arrays[key].copy()
+                new_arrays[key][records] = array
+
+        # Update the visible shapes from the last record, so that the indices
+        # of the previous ones in the list do not change
+        shapes = list(decoded['shapes'])
+        new_shapes = self._shapes_list(updated, np.ones(len(records), bool))
+        changed = []
+        for record, new_shape, visible in reversed(list(zip(records, new_shapes, updated['visible'].tolist()))):
+            i = int(np.count_nonzero(arrays['visible'][:record]))
+            was_visible = bool(arrays['visible'][record])
+            if was_visible and visible:
+                shapes[i] = new_shape
+            elif was_visible:
+                del shapes[i]
+            elif visible:
+                shapes.insert(i, new_shape)
+            else:
+                continue
+            changed.append(record)
+        changed.reverse()
+        return {'background': background, 'shapes': shapes,
+                'annotations': decoded['annotations'], 'arrays': new_arrays}, changed
+
+    def visible_shapes(self, arrays):
+        """
+        Return the (color, points, extra) of the visible shapes in the decoded `arrays`.
+        """
+        return self._shapes_list(arrays, arrays['visible'])
+
+    def _shapes_list(self, arrays, mask):
+        """
+        Return the (color, points, extra) of the shapes selected by `mask` in `arrays`.
+        """
+        colors = arrays['colors'][mask].tolist()
+        points = arrays['points'][mask].tolist()
+        if arrays['extra'] is None:
+            extras = [None] * len(colors)
+        else:
+            extras = arrays['extra'][mask].tolist()
+        return [
+            (tuple(color), [tuple(point) for point in shape_points], extra)
+            for color, shape_points, extra in zip(colors, points, extras)
+        ]
+
+    def _decode_sequential(self, sequence):
+        """
+        Same as `decode`, reading one field at a time (reference implementation).
+        """
+        sequence = to_string(sequence)
         self.index = 0
         shapes = []
         annotations = {}
@@ -120,25 +342,40 @@ class ShapesEncoder:
         return {'background': bg_color, 'shapes': shapes,
                 'annotations': annotations}
 
-    def generate(self, set_visibility=None):
+    def generate(self, set_visibility=None, rng=None, packed=False):
         """
         Generate a random binary string.
 
         :param set_visibility: set all shapes visible or not.
+        :param rng: numpy Generator (see `genome.default_rng`)
+        :param packed: return a `PackedGenome`
+        """
+        return self.generate_many(1, set_visibility, rng, packed)[0]
+
+    def generate_many(self, n, set_visibility=None, rng=None, packed=False):
+        """
+        Generate `n` random genomes at once (see `generate`).
         """
-        pre_seq = [choice(BASES) for _ in range(self.genome_size)]
+        bits = random_bits((n, self.genome_size), rng)
         if set_visibility is not None:
-            decoded = self.decode(''.join(pre_seq))
-            for shape_visibility_pos in decoded['annotations']['visibility']:
-                pre_seq[shape_visibility_pos] = str(int(set_visibility))
-        return ''.join(pre_seq)
+            bits[:, self.visibility_positions] = int(set_visibility)
+        if packed:
+            return [PackedGenome(data.tobytes(), self.genome_size) for data in np.packbits(bits, axis=1)]
+        text = (bits + ord('0')).tobytes().decode()
+        return [text[start: start + self.genome_size] for start in range(0, len(text), self.genome_size)]
 
     def draw(self, sequence):
         """
-        Convert `sequence` into a Pillow image (in memory).
+        Convert `sequence` into a Pillow image (in memory),
+        or a numpy array with the numpy renderer.
         """
-        decoded = self.decode(sequence)
+        return self.render(self.decode(sequence))
 
+    def render(self, decoded, scale=1):
+        """
+        Convert an already `decoded` sequence into a Pillow image (in memory)
+        or a numpy array (see `draw`), optionally resized by `scale`.
+        """
         # FIXME: no worning but use less channels for the bg if needed
         if not self.bg_warned:
             bg_color = decoded['background'][: len(self.image_mode)]
@@ -148,13 +385,78 @@ class ShapesEncoder:
                 ))
                 self.bg_warned = True
 
-        return draw_shapes(
+        buffers = {}
+        if self.canvas_pool and scale == 1:
+            buffers['out'] = self.canvas_pool.acquire(self.new_canvas)
+            if self.renderer == 'numpy':
+                buffers['canvas'] = self.scratch_canvas()
+        image = RENDERERS[self.renderer](
             self.image_size, decoded['shapes'], self.shape,
             decoded['background'],
             dst_image_mode=self.image_mode,
             draw_image_mode=self.draw_image_mode,
-            symmetry=self.symmetry,
+            symmetry=self.shapes_symmetry,
+            scale=scale,
+            **buffers
         )
+        return self.mirrored(image)
+
+    def mirrored(self, image):
+        """
+        Return `image` made symmetric in place, in mirror mode (see `drawer.mirror_pixels`).
+        """
+        if not self.mirror:
+            return image
+        if isinstance(image, np.ndarray):
+            mirror_pixels(np.moveaxis(image, -1, 0), self.symmetry)
+            return image
+        return mirror_image(image, self.symmetry)
+
+    def new_canvas(self):
+        """
+        Return a new (uninitialized) image, as drawn by `render`.
+        """
+        if self.renderer == 'numpy':
+            width, height = self.image_size
+            return np.empty((height, width, len(self.image_mode)), np.uint8)
+        return Image.new(self.image_mode, self.image_size)
+
+    def scratch_canvas(self):
+        """
+        Return the float canvas reused by the numpy rasterizer to draw (with the canvas pool).
+        """
+        if self.canvas_pool.scratch is None:
+            self.canvas_pool.scratch = new_canvas(self.image_size, 'black', len(self.image_mode))
+        return self.canvas_pool.scratch
+
+    def release(self, phenotype):
+        """
+        Give back an image drawn by `render` no longer used,
+        to be reused with the canvas pool.
+        """
+        if self.canvas_pool:
+            self.canvas_pool.release(phenotype)
+
+    def dirty_box(self, decoded_a, decoded_b, records=None):
+        """
+        Return the image region which can differ between two decoded sequences,
+        as a (left, upper, right, lower) box, or None if they are drawn the same.
+
+        If the indices of the changed shape `records` are given (see `decode_update`),
+        only their shapes are compared.
+        """
+        if decoded_a['background'] != decoded_b['background']:
+            return (0, 0) + tuple(self.image_size)
+        if records is None:
+            changed = changed_shapes(decoded_a['shapes'], decoded_b['shapes'])
+        else:
+            changed = []
+            for arrays in (decoded_a['arrays'], decoded_b['arrays']):
+                visible = [record for record in records if arrays['visible'][record]]
+                changed += self._shapes_list(arrays, visible)
+        if not changed:
+            return None
+        return shapes_box(self.image_size, changed, self.shape, self.symmetry)
 
 
 def demo():
@@ -0,0 +1,111 @@
+"""
+Numpy arrays in shared memory blocks, to share read-only data between processes.
+
+The arrays of a structure (nested lists, tuples and dicts) are copied in a
+block once, by `share_arrays`; other processes get only the block name and
+the specs of the arrays, and `attach_arrays` maps the block (once per process)
+and returns the same structure with views on it.
+"""
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Alignment of the arrays in a block
+ALIGNMENT = 64
+
+# Blocks mapped by this process, by name, and the ones created by it
+_blocks = {}
+_owned = set()
+
+
+class ArraySpec:
+    """
+    Offset, shape and dtype of an array in a shared memory block.
+    """
+    __slots__ = ('offset', 'shape', 'dtype')
+
+    def __init__(self, offset, shape, dtype):
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+
+    def __getstate__(self):
+        return self.offset, self.shape, self.dtype
+
+    def __setstate__(self, state):
+        self.offset, self.shape, self.dtype = state
+
+    def __repr__(self):
+        return 'ArraySpec({}, {}, {!r})'.format(self.offset, self.shape, self.dtype)
+
+    def view(self, buffer):
+        """
+        Return the read-only array on `buffer`.
+        """
+        array = np.ndarray(self.shape, self.dtype, buffer, self.offset)
+        array.flags.writeable = False
+        return array
+
+
+def _walk(value, function, leaf_type):
+    """
+    Return `value` with `function(leaf)` in place of its `leaf_type` items,
+    in nested lists, tuples and dicts.
+    """
+    if isinstance(value, leaf_type):
+        return function(value)
+    if isinstance(value, dict):
+        return {key: _walk(item, function, leaf_type) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_walk(item, function, leaf_type) for item in value)
+    return value
+
+
+def share_arrays(value):
+    """
+    Copy the arrays of `value` in a new shared memory block.
+
+    Return the block name, `value` with the specs of the arrays in their place
+    (see `attach_arrays`) and `value` with read-only views on the block
+    in their place.
+    """
+    arrays = []
+    size = 0
+
+    def add(array):
+        nonlocal size
+        spec = ArraySpec(size, array.shape, array.dtype.str)
+        arrays.append((spec, array))
+        size += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+        return spec
+
+    specs = _walk(value, add, np.ndarray)
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    _blocks[block.name] = block
+    _owned.add(block.name)
+    for spec, array in arrays:
+        np.ndarray(spec.shape, spec.dtype, block.buf, spec.offset)[...] = array
+    return block.name, specs, attach_arrays(block.name, specs)
+
+
+def attach_arrays(name, specs):
+    """
+    Return `specs` (see `share_arrays`) with read-only views on the arrays
+    of the block `name` in their place.
+    """
+    block = _blocks.get(name)
+    if block is None:
+        block = _blocks[name] = shared_memory.SharedMemory(name)
+    return _walk(specs, lambda spec: spec.view(block.buf), ArraySpec)
+
+
+def unlink_arrays(name):
+    """
+    Remove the block `name`, if created by this process: its memory is
+    freed when no process maps it any more.
+
+    The block stays mapped here, so the views on it are still valid.
+    """
+    if name in _owned:
+        _owned.remove(name)
+        _blocks[name].unlink()
@@ -1,6 +1,20 @@
-from drawer import draw_shapes, Shape
+from drawer import draw_as_svg, draw_shapes, Shape
 
 
 def test_draw_triangle():
     actual = draw_shapes((2, 2), dst_image_mode='L', draw_image_mode='L', shapes=[], shape=Shape.TRIANGLE, background_color='white')
     assert list(actual.getdata()) == [255, 255, 255, 255]
+
+
+def test_mirror_svg(tmp_path):
+    shapes = [((255, 0, 0, 128), [(0, 0), (3, 0), (0, 3)], None)]
+    filename = str(tmp_path / 'drawing.svg')
+    draw_as_svg(filename, (9, 7), shapes, Shape.TRIANGLE, (255, 255, 255, 255), symmetry='xy')
+    assert open(filename).read().count('<polygon') == 1 + 4
+    # Drawn once, then mirrored as `mirror_image` does
+    draw_as_svg(filename, (9, 7), shapes, Shape.TRIANGLE, (255, 255, 255, 255), symmetry='xy', mirror=True)
+    svg = open(filename).read()
+    assert svg.count('<polygon') == 1 + 1
+    assert 'transform="translate(9, 0) scale(-1, 1)"' in svg
+    assert 'transform="translate(0, 7) scale(1, -1)"' in svg
+    assert svg.count('clip-path=') == 2
@@ -1,5 +1,9 @@
+import random
+
+import numpy as np
 import pytest
 
+from genome import flip_mutate, to_packed
 from shapes_encoder import Shape, ShapesEncoder
 
 
@@ -35,6 +39,12 @@ def test_decode_rgba():
         '1' * 32,  # ellipse color
     ])
     actual = encoder.decode(seq)
+    # Same decoding as arrays, for `decode_update`
+    arrays = actual.pop('arrays')
+    assert arrays['visible'].tolist() == [True]
+    assert arrays['points'].tolist() == [[[0, 1], [1, 0]]]
+    assert arrays['colors'].tolist() == [[255, 255, 255, 255]]
+    assert (arrays['background'], arrays['starts']) == ((0, 0, 0, 0), [32])
     assert actual == {
         'background': (0, 0, 0, 0),
         'shapes': [
@@ -92,3 +102,83 @@ def test_grayscale(case):
     dec = encoder.decode(case['genome'])
     assert dec['background'] == case['background']
     assert dec['shapes'] == case['shapes']
+
+
+@pytest.mark.parametrize('renderer', ['pil', 'numpy'])
+def test_canvas_pool(renderer):
+    encoder = ShapesEncoder((16, 8), n_shapes=8, renderer=renderer)
+    pooled = ShapesEncoder((16, 8), n_shapes=8, renderer=renderer, canvas_pool=2)
+    genomes = [encoder.generate() for _ in range(4)]
+    for genome in genomes:
+        image = pooled.draw(genome)
+        assert np.array_equal(np.asarray(image), np.asarray(encoder.draw(genome)))
+        pooled.release(image)
+    assert (pooled.canvas_pool.n_allocated, pooled.canvas_pool.n_reused) == (1, 3)
+
+
+@pytest.mark.parametrize('shape', ['t', 'c', 'l'])
+@pytest.mark.parametrize('size', [(16, 8), (10, 6), (1, 1)])
+def test_decode_as_sequential(shape, size):
+    random.seed(0)
+    encoder = ShapesEncoder(size, shape=shape, n_shapes=4)
+    lengths = [encoder.genome_size, encoder.genome_size - 3, encoder.genome_size + 7, encoder.background_bits]
+    for length in lengths:
+        sequence = ''.join(random.choice('01') for _ in range(length))
+        decoded = encoder.decode(sequence)
+        expected = encoder._decode_sequential(sequence)
+        assert decoded['background'] == expected['background']
+        assert decoded['shapes'] == expected['shapes']
+        assert decoded['annotations'] == expected['annotations']
+        packed = encoder.decode(to_packed(sequence))
+        assert (packed['background'], packed['shapes']) == (decoded['background'], decoded['shapes'])
+
+
+def test_locate():
+    encoder = ShapesEncoder((16, 8), shape='t', n_shapes=4)
+    record_bits = 1 + (4 + 3) * 4 + 32
+    assert encoder.record_bits == record_bits
+    records, fields = encoder.locate([0, 32, 33, 32 + 7, 32 + 8, 32 + record_bits + record_bits - 1])
+    assert records.tolist() == [-1, 0, 0, 0, 0, 1]
+    assert fields == ['background', 'visible', 'position_x', 'position_y', 'point0_x', 'color3']
+
+
+@pytest.mark.parametrize('shape', ['t', 'l'])
+@pytest.mark.parametrize('extra_length', [0, 5])
+@pytest.mark.parametrize('packed', [False, True])
+def test_decode_update(shape, extra_length, packed):
+    random.seed(0)
+    encoder = ShapesEncoder((16, 8), shape=shape, n_shapes=6)
+    father = encoder.generate()
+    father += father[: extra_length]
+    if packed:
+        father = to_packed(father)
+    father_decoded = encoder.decode(father)
+    for _ in range(50):
+        positions = random.sample(range(len(father)), random.randint(0, 4))
+        child = flip_mutate(positions, father)
+        decoded, records = encoder.decode_update(father_decoded, child, positions)
+        expected = encoder.decode(child)
+        assert decoded['background'] == expected['background']
+        assert decoded['shapes'] == expected['shapes']
+        for key in ('visible', 'points', 'colors'):
+            assert (decoded['arrays'][key] == expected['arrays'][key]).all()
+        touched = {record for record in encoder.locate(positions)[0].tolist() if record >= 0}
+        assert set(records) <= touched
+        assert encoder.dirty_box(father_decoded, decoded, records) == encoder.dirty_box(father_decoded, expected)
+
+
+@pytest.mark.parametrize('shape', ['t', 'l'])
+@pytest.mark.parametrize('set_visibility', [None, False, True])
+def test_generate_many(shape, set_visibility):
+    encoder = ShapesEncoder((16, 8), shape=shape, n_shapes=6)
+    genomes = encoder.generate_many(5, set_visibility, rng=np.random.default_rng(0))
+    assert len(set(genomes)) == 5
+    assert all(len(genome) == encoder.genome_size and set(genome) <= set('01') for genome in genomes)
+    assert encoder.generate_many(5, set_visibility, rng=np.random.default_rng(0), packed=True) == \
+        [to_packed(genome) for genome in genomes]
+    assert encoder.generate(set_visibility, rng=np.random.default_rng(0)) == genomes[0]
+    for genome in genomes:
+        visibility = encoder.decode(genome)['annotations']['visibility']
+        assert visibility == encoder.visibility_positions.tolist()
+        if set_visibility is not None:
+            assert {genome[position] for position in visibility} == {str(int(set_visibility))}
@@ -0,0 +1,200 @@
+import pickle
+import random
+from functools import partial
+from multiprocessing import get_context
+from multiprocessing.reduction import ForkingPickler
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from evaluator import (
+    REJECTED, CachedEvaluator, CoarseToFineEvaluator, ImageEvaluator, IncrementalEvaluator, SampledEvaluator,
+    func_evaluate, func_evaluate_batch, stack_images, with_phenotype,
+)
+from drawer import mirror_pixels
+from genome import flip_mutate
+from shapes_encoder import ShapesEncoder
+
+
+@pytest.mark.parametrize('shape,symmetry', [
+    ('t', ''),
+    ('q', 'x'),
+    ('c', 'xy'),
+])
+def test_incremental_evaluation(target, shape, symmetry):
+    evaluator = ImageEvaluator(target)
+    encoder = ShapesEncoder(evaluator.target_size, shape=shape, n_shapes=16, symmetry=symmetry)
+    incremental = IncrementalEvaluator(encoder, evaluator)
+    father = func_evaluate(encoder, evaluator, encoder.generate())
+    incremental.set_father(father)
+    for _ in range(50):
+        positions = random.sample(range(encoder.genome_size), random.randint(1, 3))
+        child = incremental(flip_mutate(positions, father['genome']))
+        assert child['evaluation'] == evaluator.evaluate(child['phenotype'])
+        early = incremental(child['genome'], threshold=father['evaluation'])
+        if child['evaluation'] >= father['evaluation']:
+            assert early['evaluation'] is REJECTED
+        else:
+            assert early['evaluation'] == child['evaluation']
+        if child['evaluation'] < father['evaluation']:
+            father = child
+            incremental.set_father(father)
+            assert (incremental.father_error_map == evaluator.error_map(father['phenotype'])).all()
+
+
+@pytest.mark.parametrize('mode', ['L', 'RGB', 'RGBA'])
+def test_evaluate(target, mode):
+    evaluator = ImageEvaluator(target, dst_image_mode=mode)
+    candidate = Image.new(mode, evaluator.target_size, color='white')
+    expected = ((np.asarray(evaluator.target_image, dtype=np.int64) - 255) ** 2).sum()
+    assert evaluator.evaluate(candidate) == expected
+    assert evaluator.error_map(candidate).sum() == expected
+
+
+def test_evaluate_batch(target):
+    evaluator = ImageEvaluator(target)
+    encoder = ShapesEncoder(evaluator.target_size, n_shapes=8)
+    genomes = [encoder.generate() for _ in range(20)]
+    batch = func_evaluate_batch(encoder, evaluator, genomes)
+    assert [rv['evaluation'] for rv in batch] == \
+        [func_evaluate(encoder, evaluator, genome)['evaluation'] for genome in genomes]
+    assert len(evaluator.evaluate_batch(stack_images([]))) == 0
+
+
+def test_evaluate_threshold(target):
+    evaluator = ImageEvaluator(target)
+    evaluator.band_rows = 5
+    candidate = Image.new('RGB', evaluator.target_size, color='white')
+    evaluation = evaluator.evaluate(candidate)
+    assert evaluator.evaluate(candidate, threshold=evaluation + 1) == evaluation
+    assert evaluator.evaluate(candidate, threshold=evaluation) is REJECTED
+    assert evaluator.error_map(candidate, threshold=evaluation + 1).sum() == evaluation
+    assert evaluator.error_map(candidate, threshold=evaluation) is None
+
+
+def test_coarse_to_fine(target):
+    evaluator = ImageEvaluator(target, pyramid_levels=2)
+    assert [len(level) for level in evaluator.pyramid] == [16 * 12 * 3, 8 * 6 * 3]
+    encoder = ShapesEncoder(evaluator.target_size, n_shapes=16)
+    evaluate = CoarseToFineEvaluator(encoder, evaluator, partial(func_evaluate, encoder, evaluator))
+    father = func_evaluate(encoder, evaluator, encoder.generate())
+    evaluate.set_father(father)
+    # Not better, even at coarse levels
+    assert evaluate(father['genome'])['evaluation'] is REJECTED
+    for _ in range(50):
+        child = evaluate(flip_mutate([random.randrange(encoder.genome_size)], father['genome']))
+        if child['evaluation'] is not REJECTED:
+            assert child['evaluation'] == evaluator.evaluate(child['phenotype'])
+    assert evaluate.n_screened == 51
+
+
+def test_sampled(target):
+    evaluator = ImageEvaluator(target, sample_fraction=0.25, sample_sets=3)
+    assert [len(indices) for indices, values in evaluator.samples] == [(24 * 32 // 4) * 3] * 3
+    encoder = ShapesEncoder(evaluator.target_size, n_shapes=16)
+    evaluate = SampledEvaluator(encoder, evaluator)
+    father = func_evaluate(encoder, evaluator, encoder.generate())
+    evaluate.set_father(father)
+    assert evaluate(father['genome'])['evaluation'] is REJECTED
+    for _ in range(50):
+        child = evaluate(flip_mutate([random.randrange(encoder.genome_size)], father['genome']))
+        if child['evaluation'] is not REJECTED:
+            assert child['evaluation'] == evaluator.evaluate(child['phenotype'])
+
+
+def test_sampled_incremental(target, monkeypatch):
+    random.seed(1)
+    evaluator = ImageEvaluator(target, sample_fraction=0.25, sample_sets=3)
+    random.seed(1)
+    assert [indices.tolist() for indices, values in evaluator.samples] == \
+        [indices.tolist() for indices, values in ImageEvaluator(target, sample_fraction=0.25, sample_sets=3).samples]
+    encoder = ShapesEncoder(evaluator.target_size, n_shapes=16)
+    incremental = IncrementalEvaluator(encoder, evaluator)
+    evaluate = SampledEvaluator(encoder, evaluator, incremental)
+    father = func_evaluate(encoder, evaluator, encoder.generate())
+    evaluate.set_father(father)
+    renders = []
+    render = encoder.render
+    monkeypatch.setattr(encoder, 'render', lambda decoded: renders.append(1) or render(decoded))
+    for n in range(1, 31):
+        child = evaluate(flip_mutate([random.randrange(encoder.genome_size)], father['genome']))
+        # Drawn once, for the estimate and the exact evaluation
+        assert len(renders) == n
+        if child['evaluation'] is not REJECTED:
+            assert child['evaluation'] == evaluator.evaluate(child['phenotype'])
+
+
+def test_cached(target):
+    evaluator = ImageEvaluator(target)
+    encoder = ShapesEncoder(evaluator.target_size, n_shapes=8)
+    evaluate = CachedEvaluator(
+        partial(func_evaluate, encoder, evaluator), maxsize=4,
+        evaluate_batch=partial(func_evaluate_batch, encoder, evaluator),
+    )
+    genomes = [encoder.generate() for _ in range(3)]
+    first = evaluate(genomes[0])
+    cached = evaluate(genomes[0])
+    assert cached['phenotype'] is None
+    assert cached['evaluation'] == first['evaluation']
+    assert with_phenotype(encoder, cached)['phenotype'].tobytes() == first['phenotype'].tobytes()
+    batch = evaluate.batch(genomes)
+    assert [rv['evaluation'] for rv in batch] == \
+        [func_evaluate(encoder, evaluator, genome)['evaluation'] for genome in genomes]
+    assert (evaluate.cache.hits, evaluate.cache.misses) == (2, 3)
+
+
+def test_incremental_evaluation_numpy_renderer(target):
+    evaluator = ImageEvaluator(target)
+    encoder = ShapesEncoder(evaluator.target_size, n_shapes=16, renderer='numpy')
+    incremental = IncrementalEvaluator(encoder, evaluator)
+    father = func_evaluate(encoder, evaluator, encoder.generate())
+    incremental.set_father(father)
+    for _ in range(20):
+        child = incremental(flip_mutate([random.randrange(encoder.genome_size)], father['genome']))
+        assert child['evaluation'] == evaluator.evaluate(child['phenotype'])
+
+
+@pytest.mark.parametrize('symmetry', ['x', 'y', 'o', 'xy'])
+def test_mirror_folded_evaluation(target, symmetry):
+    evaluator = ImageEvaluator(target)
+    folded = ImageEvaluator(target, fold_symmetry=symmetry)
+    for renderer in ('pil', 'numpy'):
+        encoder = ShapesEncoder(evaluator.target_size, n_shapes=16, symmetry=symmetry, renderer=renderer, mirror=True)
+        for _ in range(5):
+            phenotype = encoder.draw(encoder.generate())
+            pixels = np.moveaxis(np.asarray(phenotype).reshape(24, 32, -1), -1, 0)
+            assert (mirror_pixels(pixels.copy(), symmetry) == pixels).all()
+            evaluation = evaluator.evaluate(phenotype)
+            assert folded.evaluate(phenotype) == evaluation
+            assert folded.evaluate(phenotype, threshold=evaluation) is REJECTED
+
+
+def test_shared(target):
+    evaluator = ImageEvaluator(target, pyramid_levels=2, sample_fraction=0.25, fold_symmetry='x')
+    candidate = Image.new('RGB', evaluator.target_size, color='white')
+    coarse = Image.new('RGB', (16, 12), color='white')
+    def evaluations(evaluator):
+        return [
+            evaluator.evaluate(candidate),
+            evaluator.evaluate_coarse(coarse, 1),
+            evaluator.evaluate_sample(candidate, 0),
+        ]
+
+    expected = evaluations(evaluator)
+    size = len(ForkingPickler.dumps(evaluator))
+    evaluator.share()
+    try:
+        assert len(ForkingPickler.dumps(evaluator)) < size / 4
+        # The checkpoints carry the arrays
+        assert pickle.loads(pickle.dumps(evaluator)).shared is None
+        copy = ForkingPickler.loads(ForkingPickler.dumps(evaluator))
+        assert copy.shared[0] == evaluator.shared[0]
+        assert (copy.target_image.tobytes(), copy.fold[3]) == (evaluator.target_image.tobytes(), evaluator.fold[3])
+        for shared in (evaluator, copy):
+            assert evaluations(shared) == expected
+        # Attached by name in a new process
+        with get_context('spawn').Pool(1) as pool:
+            assert pool.apply(evaluator.evaluate, (candidate,)) == expected[0]
+    finally:
+        evaluator.unlink()
@@ -0,0 +1,128 @@
+import pickle
+import random
+from collections import Counter
+from itertools import chain
+from math import comb
+
+import numpy as np
+import pytest
+
+from genome import (
+    AdaptiveMutationRates, PackedGenome, distance_matrix, distances_to, flip_mutate, generate, genetic_distances,
+    genome_bits, genome_digest, get_probs_k_mutations, get_rand_positions, join_bases, opposite_genome,
+    rand_mut_positions, to_packed, to_string, transpose_genome,
+)
+
+
+@pytest.mark.parametrize('genome', ['', '0', '1', '10110', '0' * 8, '1' * 9, '1001' * 33])
+def test_packed_genome_roundtrip(genome):
+    packed = PackedGenome.from_string(genome)
+    assert len(packed) == len(genome)
+    assert str(packed) == to_string(packed) == genome
+    assert to_packed(genome) == packed == PackedGenome.from_bits(genome_bits(genome))
+    assert (genome_bits(packed) == genome_bits(genome)).all()
+    assert join_bases(genome, packed=True) == packed
+    assert pickle.loads(pickle.dumps(packed)) == packed
+    assert hash(to_packed(genome)) == hash(packed)
+
+
+def test_packed_genome_operators_as_strings():
+    random.seed(0)
+    genome = ''.join(random.choice('01') for _ in range(101))
+    packed = to_packed(genome)
+    assert str(opposite_genome(packed)) == opposite_genome(genome)
+    for _ in range(20):
+        positions = random.sample(range(len(genome)), random.randint(0, 5))
+        assert str(flip_mutate(positions, packed)) == flip_mutate(positions, genome)
+        start, end, dst = sorted(random.randrange(len(genome)) for _ in range(3))
+        replicative, inverted = random.random() < 0.5, random.random() < 0.5
+        transposed = transpose_genome(genome, start, end, dst, replicative=replicative, inverted=inverted)
+        assert str(transpose_genome(packed, start, end, dst, replicative=replicative, inverted=inverted)) == transposed
+        other = flip_mutate(positions, transposed)
+        assert genetic_distances(packed, to_packed(other)) == genetic_distances(genome, other)
+    with pytest.raises(IndexError):
+        flip_mutate([len(genome)], packed)
+
+
+def test_packed_genome_size():
+    genome = '01' * 5000
+    packed = to_packed(genome)
+    assert len(packed.data) == 10000 // 8
+    assert len(pickle.dumps(packed)) < len(pickle.dumps(genome)) / 6
+    assert genome_digest(packed) == genome_digest(to_packed(genome))
+    assert genome_digest(packed) != genome_digest(flip_mutate([0], packed))
+
+
+def test_generate():
+    random.seed(0)
+    genome = generate('01', 1000)
+    random.seed(0)
+    assert generate('01', 1000) == genome
+    assert 400 < genome.count('1') < 600
+    assert set(generate('ACGT', 100, rng=np.random.default_rng(0))) == set('ACGT')
+
+
+def test_distance_matrix():
+    random.seed(0)
+    genomes = [generate('01', length) for length in (0, 5, 64, 67, 67, 100)]
+    genomes.append(flip_mutate([1, 2, 66], genomes[4]))
+    expected = [
+        [sum(a != b for a, b in zip(genome_a, genome_b)) for genome_b in genomes]
+        for genome_a in genomes
+    ]
+    packed = [to_packed(genome) for genome in genomes]
+    assert distance_matrix(genomes).tolist() == expected
+    assert distance_matrix(packed).tolist() == expected
+    assert distance_matrix(genomes[:1] + packed[1:]).tolist() == expected
+    assert distances_to(genomes[4], packed).tolist() == expected[4]
+    assert genetic_distances(*genomes[3:]) == [expected[3][4], expected[3][5], expected[3][6],
+                                              expected[4][5], expected[4][6], expected[5][6]]
+    assert distance_matrix([]).shape == (0, 0)
+
+
+def test_probs_k_mutations():
+    probs = get_probs_k_mutations(10, 0.3, cutoff=0)
+    assert probs == pytest.approx([comb(10, k) * 0.3 ** k * 0.7 ** (10 - k) for k in range(11)])
+    # Long genomes, also with high rates
+    for rate in (1 / 20000, 0.5):
+        probs = get_probs_k_mutations(20000, rate)
+        assert sum(probs) == pytest.approx(1)
+        assert probs.index(max(probs)) == int(20000 * rate)
+
+
+def test_rand_mut_positions_distribution():
+    """
+    The fast extraction of mutation positions is distributed as the slow one
+    (one random number for each base).
+    """
+    random.seed(0)
+    length, rate, n_extractions = 50, 2 / 50, 20000
+    fast = rand_mut_positions(length, rate, batch_size=1000)
+    extractions = {
+        'slow': [get_rand_positions(length, rate) for _ in range(n_extractions)],
+        'fast': [next(fast) for _ in range(n_extractions)],
+    }
+    for positions_list in extractions.values():
+        assert all(len(set(positions)) == len(positions) for positions in positions_list)
+    n_mutations = {name: Counter(map(len, positions_list)) for name, positions_list in extractions.items()}
+    positions = {name: Counter(chain(*positions_list)) for name, positions_list in extractions.items()}
+    for k in range(6):
+        assert n_mutations['fast'][k] == pytest.approx(n_mutations['slow'][k], rel=0.1, abs=20)
+    expected = n_extractions * rate
+    for position in range(length):
+        for name in extractions:
+            assert positions[name][position] == pytest.approx(expected, rel=0.2)
+
+
+def test_adaptive_mutation_rates():
+    random.seed(0)
+    rates = AdaptiveMutationRates(10, good_counts=[3], bad_counts=np.array([0, 2] + [0] * 9 + [1]))
+    assert rates.weight(0) == 4 / 5 and rates.weight(1) == 1 / 4 and rates.weight(2) == 1 / 2
+    # Dead bases, never improving, are drawn less and less
+    for _ in range(50):
+        rates.update(range(5, 10), improved=False)
+    assert sum(rates.rates(2.0)) == pytest.approx(2.0)
+    counts = Counter(chain(*(rates.sample(2) for _ in range(2000))))
+    assert sum(counts[position] for position in range(5, 10)) < 0.05 * 4000
+    assert counts[0] > counts[2] > counts[1]
+    assert sorted(rates.sample(20)) == list(range(10))
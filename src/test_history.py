@@ -0,0 +1,19 @@
+from argparse import Namespace
+from types import SimpleNamespace
+
+import numpy as np
+
+from history import ISLA_GENOMES_FILENAME, MUTATION_COUNTS_FILENAME, HistoryIO, load_mutation_counts
+
+
+def test_save_mutation_counts(tmp_path):
+    history_io = HistoryIO(Namespace(target=str(tmp_path / 'target.png'), restart=False))
+    island = SimpleNamespace(
+        id='abc', iteration=7, best={'genome': '0110'},
+        good_mutation_counts=np.array([0, 1, 0, 2], np.uint32), bad_mutation_counts=np.array([5, 0, 3, 1], np.uint32),
+    )
+    history_io.save_island_stuff(island, save_mutation_counts=True)
+    good, bad = load_mutation_counts(history_io._path('abc', MUTATION_COUNTS_FILENAME))
+    assert good.tolist() == [0, 1, 0, 2] and bad.tolist() == [5, 0, 3, 1]
+    with open(history_io._path('abc', ISLA_GENOMES_FILENAME)) as fp:
+        assert fp.read().split() == ['7', '0110']
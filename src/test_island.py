@@ -0,0 +1,70 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from evaluator import ImageEvaluator
+from island import Island, resized
+from shapes_encoder import ShapesEncoder
+
+
+def test_resized():
+    counts = np.array([1, 2, 3], np.uint32)
+    assert resized(counts, 3) is counts
+    assert resized(counts, 5).tolist() == [1, 2, 3, 0, 0]
+    assert resized(counts, 2).tolist() == [1, 2]
+    assert resized(counts, 5).dtype == np.uint32
+
+
+@pytest.mark.parametrize('kwargs', [
+    {},
+    {'n_mutants': 4},
+    {'n_mutants': 4, 'incremental': True, 'packed': True, 'p_position': True},
+])
+def test_island_run(target, kwargs):
+    evaluator = ImageEvaluator(target)
+    encoder = ShapesEncoder(evaluator.target_size, n_shapes=16)
+    island = Island(0, encoder, evaluator, run_iterations=200, **kwargs)
+    start = island.best_evaluation
+    island.run()
+    assert island.iteration == 200
+    assert island.best_evaluation <= start
+    assert island.best_evaluation == evaluator.evaluate(encoder.draw(island.best['genome']))
+    flips = [mutation for iteration, mutation in island.last_run_good_mutations if mutation[0] == 'F']
+    assert island.good_mutation_counts.sum() == sum(len(positions) for kind, positions in flips)
+
+
+def test_rejection_cache(target):
+    evaluator = ImageEvaluator(target)
+    encoder = ShapesEncoder(evaluator.target_size, n_shapes=16)
+    island = Island(0, encoder, evaluator, run_iterations=300, k_mut=0.5, rejection_cache=8)
+    island.run()
+    assert 0 < len(island.rejected) <= 8
+    assert island.rejected.hits > 0
+    assert all(isinstance(key, frozenset) or key[0] == 'T' for key in island.rejected.data)
+    island.set_best(island.best)
+    assert len(island.rejected) == 0
+
+
+def test_pickle(target):
+    evaluator = ImageEvaluator(target, pyramid_levels=1)
+    encoder = ShapesEncoder(evaluator.target_size, n_shapes=16)
+    island = Island(
+        0, encoder, evaluator, run_iterations=100, incremental=True, prescreen_margin=0.1,
+        cache_size=64, layer_cache=4, p_position=True)
+    island.run()
+    sizes = [len(pickle.dumps(island))]
+    copy = pickle.loads(pickle.dumps(island))
+    assert copy.best['phenotype'] is None and copy.best['evaluation'] == island.best_evaluation
+    assert [type(child) for child in copy.child_evaluators] == [type(child) for child in island.child_evaluators]
+    assert copy.layer_cache.every == 4
+    # The caches contents survive
+    assert len(island.rejected) > 0 and copy.rejected.data == island.rejected.data
+    assert copy.child_evaluator.cache.data == island.child_evaluator.cache.data
+    assert copy.mutation_rates.good == island.mutation_rates.good
+    for _ in range(3):
+        copy.run()
+        assert copy.best_evaluation == evaluator.evaluate(encoder.draw(copy.best['genome']))
+        sizes.append(len(pickle.dumps(copy)))
+    # Bounded by the genome and the last run
+    assert max(sizes) < 2 * min(sizes)
@@ -0,0 +1,42 @@
+import random
+
+import numpy as np
+import pytest
+
+from drawer import as_image
+from genome import flip_mutate
+from layer_cache import LayerCache, first_difference
+from shapes_encoder import ShapesEncoder
+
+
+def test_first_difference():
+    assert first_difference([1, 2, 3], [1, 2, 3]) is None
+    assert first_difference([1, 2, 3], [1, 5, 3]) == 1
+    assert first_difference([1, 2, 3], [1, 2]) == 2
+    assert first_difference([], [1]) == 0
+
+
+@pytest.mark.parametrize('renderer,symmetry,canvas_pool', [
+    ('pil', '', 0),
+    ('pil', 'x', 0),
+    ('numpy', '', 0),
+    ('pil', '', 2),
+    ('numpy', '', 2),
+])
+def test_layer_cache_renders_as_encoder(renderer, symmetry, canvas_pool):
+    random.seed(0)
+    encoder = ShapesEncoder((32, 24), n_shapes=32, symmetry=symmetry, renderer=renderer, canvas_pool=canvas_pool)
+    layer_cache = LayerCache(encoder, every=4)
+    father = encoder.generate()
+    layer_cache.set_reference(father)
+    for i in range(40):
+        child = flip_mutate([random.randrange(encoder.genome_size)], father)
+        expected = np.asarray(as_image(encoder.draw(child)))
+        image = layer_cache.draw(child)
+        assert (np.asarray(as_image(image)) == expected).all()
+        layer_cache.release(image)
+        if i % 3 == 0:
+            father = child
+            layer_cache.set_reference(father)
+            assert (np.asarray(as_image(layer_cache.draw(father))) == expected).all()
+    assert layer_cache.n_layers < layer_cache.n_total_layers
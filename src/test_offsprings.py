@@ -1,5 +1,11 @@
+import random
+
+import numpy as np
 import pytest
-from mating import islands_crossover_offsprings_tournament
+
+from crossover import crossover, crossover_arrays
+from genome import PackedGenome, to_packed
+from mating import get_offsprings, islands_crossover_offsprings_tournament
 
 
 @pytest.mark.parametrize('islands,ev_offsprings,expected', [
@@ -12,3 +18,22 @@ from mating import islands_crossover_offsprings_tournament
 def test_things(islands, ev_offsprings, expected):
     rv = islands_crossover_offsprings_tournament(islands, ev_offsprings)
     assert rv == expected
+
+
+def test_packed_offsprings():
+    parents = ['0000000000', '1111111111', '0101010101']
+    random.seed(0)
+    expected = get_offsprings(parents, n_crossovers=3)
+    random.seed(0)
+    offsprings = get_offsprings([to_packed(parent) for parent in parents], n_crossovers=3)
+    assert all(isinstance(offspring, PackedGenome) for offspring in offsprings)
+    assert [str(offspring) for offspring in offsprings] == expected
+
+
+def test_crossover_arrays_as_lists():
+    random.seed(0)
+    for _ in range(500):
+        seq1, seq2 = ([random.randint(0, 1) for _ in range(random.randint(0, 12))] for _ in range(2))
+        points = [random.randint(0, 15) for _ in range(random.randint(0, 4))]
+        arr1, arr2 = crossover_arrays(np.array(seq1, int), np.array(seq2, int), points)
+        assert (arr1.tolist(), arr2.tolist()) == crossover(seq1, seq2, points)
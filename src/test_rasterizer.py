@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from drawer import Shape, draw_shapes
+from rasterizer import (
+    _centers, check_modes, new_canvas, paint_shapes, polygon_mask, rasterize_shapes, stamp_circles, triangle_mask,
+)
+
+
+def test_adjacent_triangles_do_not_overlap():
+    xs, ys = _centers((0, 0, 8, 8))
+    upper = triangle_mask((0, 0), (8, 0), (0, 8), xs, ys)
+    lower = triangle_mask((8, 8), (0, 8), (8, 0), xs, ys)
+    assert not (upper & lower).any()
+    assert (upper | lower).all()
+
+
+def test_polygon_mask_even_odd():
+    xs, ys = _centers((0, 0, 4, 4))
+    square = polygon_mask([(0, 0), (4, 0), (4, 4), (0, 4)], xs, ys)
+    assert square.all()
+    # self-intersecting "bow tie": left and right triangles meeting at the center
+    bow_tie = polygon_mask([(0, 0), (4, 4), (4, 0), (0, 4)], xs, ys)
+    assert bow_tie[1: 3, 0].all() and bow_tie[1: 3, 3].all()
+    assert not bow_tie[0, 1: 3].any() and not bow_tie[3, 1: 3].any()
+
+
+@pytest.mark.parametrize('shape,shapes', [
+    (Shape.RECT, [((0, 0, 0, 255), [(1, 1), (2, 3)], None)]),
+    (Shape.RECT, [((0, 0, 0, 255), [(0, 0), (3, 3)], None), ((255, 0, 0, 255), [(1, 1), (2, 2)], None)]),
+    (Shape.TRIANGLE, []),
+])
+def test_opaque_shapes_as_pillow(shape, shapes):
+    expected = np.asarray(draw_shapes((4, 4), shapes, shape, (255, 255, 255, 255)))
+    actual = rasterize_shapes((4, 4), shapes, shape, (255, 255, 255, 255))
+    assert actual.dtype == np.uint8
+    assert (actual == expected).all()
+
+
+def test_stamped_circles_as_ellipses():
+    rng = np.random.RandomState(0)
+    circles = [
+        (tuple(rng.randint(0, 256, 4)), [tuple(rng.randint(-12, 20, 2))], None)
+        for _ in range(30)
+    ]
+    ellipses = [(color, [(x, y), (x + 10, y + 10)], extra) for color, ((x, y),), extra in circles]
+    expected = paint_shapes(new_canvas((16, 12), 'white', 3), ellipses, Shape.ELLIPSE)
+    actual = stamp_circles(new_canvas((16, 12), 'white', 3), circles)
+    assert (actual == expected).all()
+    # Same as Pillow for opaque circles
+    opaque = [((r, g, b, 255), points, extra) for (r, g, b, a), points, extra in circles if min(points[0]) >= 0]
+    expected = np.asarray(draw_shapes((16, 12), opaque, Shape.CIRCLE))
+    assert (rasterize_shapes((16, 12), opaque, Shape.CIRCLE) == expected).all()
+
+
+def test_alpha_compositing():
+    shapes = [((0, 0, 0, 51), [(0, 0), (1, 0)], None)]
+    actual = rasterize_shapes((2, 1), shapes, Shape.RECT, (255, 255, 255, 255), 'L', 'LA')
+    assert actual.shape == (1, 2, 1)
+    assert (actual == 204).all()
+
+
+def test_unsupported_modes():
+    with pytest.raises(ValueError):
+        check_modes('RGBA', 'RGBA')
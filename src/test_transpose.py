@@ -2,7 +2,7 @@ import pytest
 from hypothesis import strategies as st
 from hypothesis import assume, given
 
-from transpose import transpose
+from transpose import transpose, transposed
 
 
 def test_reverse_whole_sequence():
@@ -113,3 +113,19 @@ def test_transpose_inside_for_set():
     assert len(seq) == 6
     assert len(set(seq)) == 6
     assert seq == list('045123')
+
+
+@given(
+    start=st.integers(min_value=0, max_value=10),
+    end=st.integers(min_value=0, max_value=10),
+    dst=st.integers(min_value=0, max_value=10),
+    replicative=st.booleans(),
+    inverted=st.booleans(),
+)
+def test_transposed_as_transpose(start, end, dst, replicative, inverted):
+    assume(start <= end)
+    seq = list('0123456789')
+    expected = seq[:]
+    transpose(expected, start, end, dst, replicative=replicative, inverted=inverted)
+    assert transposed(seq, start, end, dst, replicative=replicative, inverted=inverted) == expected
+    assert transposed(''.join(seq), start, end, dst, replicative=replicative, inverted=inverted) == ''.join(expected)
@@ -1,6 +1,10 @@
+import random
+from bisect import bisect_right
+from itertools import accumulate
+
 import pytest
 
-from utils import AccumulativeMean
+from utils import AccumulativeMean, FenwickTree, LRUCache
 
 
 @pytest.mark.parametrize('values,expected_means', [
@@ -23,3 +27,33 @@ def test_accumulative_mean__init_args(init_args, new_value, expected):
     am = AccumulativeMean(*init_args)
     am += new_value
     assert am.get_current() == expected
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.get('a') == 1
+    cache['c'] = 3  # evict 'b', the least recently used
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_fenwick_tree():
+    random.seed(0)
+    weights = [random.random() for _ in range(13)]
+    weights[4] = 0
+    tree = FenwickTree(weights)
+    for _ in range(30):
+        index, delta = random.randrange(13), random.random()
+        weights[index] += delta
+        tree.add(index, delta)
+    cum_weights = list(accumulate(weights))
+    assert tree.total == pytest.approx(cum_weights[-1])
+    assert tree.prefix_sum(5) == pytest.approx(cum_weights[4])
+    for _ in range(100):
+        value = random.random() * tree.total
+        assert tree.find(value) == bisect_right(cum_weights, value)
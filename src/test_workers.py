@@ -0,0 +1,35 @@
+import pickle
+
+from evaluator import ImageEvaluator
+from island import Island
+from shapes_encoder import ShapesEncoder
+from workers import IslandWorkers
+
+
+def test_island_workers(target):
+    evaluator = ImageEvaluator(target)
+    encoder = ShapesEncoder(evaluator.target_size, n_shapes=16)
+    islands = [Island(i, encoder, evaluator, run_iterations=100, k_mut=i + 1) for i in range(3)]
+    starts = [isla.best_evaluation for isla in islands]
+    with IslandWorkers(islands, 2) as workers:
+        for generation in range(1, 3):
+            islands, elapsed = workers.run(islands)
+            assert [isla.iteration for isla in islands] == [100 * generation] * 3
+    for isla, start in zip(islands, starts):
+        assert isla.best_evaluation <= start
+        assert isla.best_evaluation == evaluator.evaluate(encoder.draw(isla.best['genome']))
+        n_good_flips, n_bad_flips = map(len, isla.last_run_flips)
+        assert 0 < isla.bad_mutation_counts.sum() and n_bad_flips <= isla.bad_mutation_counts.sum()
+    # Much smaller than the whole island
+    summary = pickle.dumps(islands[0].run_summary())
+    assert len(summary) * 10 < len(pickle.dumps(islands[0]))
+
+
+def test_close_after_worker_exit(target):
+    evaluator = ImageEvaluator(target)
+    encoder = ShapesEncoder(evaluator.target_size, n_shapes=4)
+    workers = IslandWorkers([Island(i, encoder, evaluator) for i in range(2)], 2)
+    workers.processes[0].terminate()
+    workers.processes[0].join()
+    workers.close()
+    assert not workers.processes
@@ -3,6 +3,7 @@ Simulates DNA transposable elements, which cause mutations.
 
 Supports also replicative and inverted transposition, combined or not.
 """
+import numpy as np
 
 
 def transpose(seq, start, end, dst, replicative=False, inverted=False):
@@ -56,3 +57,39 @@ def transpose(seq, start, end, dst, replicative=False, inverted=False):
         if dst < start:
             cut_start = start + el_len
         del seq[cut_start: cut_start + el_len]
+
+
+def _concatenate(*parts):
+    if isinstance(parts[0], np.ndarray):
+        return np.concatenate(parts)
+    rv = parts[0]
+    for part in parts[1:]:
+        rv = rv + part
+    return rv
+
+
+def transposed(seq, start, end, dst, replicative=False, inverted=False):
+    """
+    Same as `transpose`, but return a new sequence, built with slices.
+
+    Works with immutable sequences too (str, tuple) and numpy arrays,
+    and it is much faster than inserting element by element.
+
+    >>> transposed('012345', 1, 3, 5)
+    '034125'
+    >>> transposed('ABCDEFGH', 2, 4, 4, replicative=True)
+    'ABCDCDEFGH'
+    >>> transposed(np.arange(6), 3, 5, 1, inverted=True).tolist()
+    [0, 4, 3, 1, 2, 5]
+    """
+    segment = seq[start: end]
+    if inverted:
+        segment = segment[::-1]
+    rv = _concatenate(seq[:dst], segment, seq[dst:])
+    if not replicative:
+        el_len = end - start
+        cut_start = start
+        if dst < start:
+            cut_start = start + el_len
+        rv = _concatenate(rv[:cut_start], rv[cut_start + el_len:])
+    return rv
@@ -4,6 +4,7 @@ Incremental averageing.
 Calculate mean accumulatively.
 https://math.stackexchange.com/questions/106700/incremental-averageing
 """
+from collections import OrderedDict
 
 
 class AccumulativeMean:
@@ -52,3 +53,116 @@ class AccumulativeMean:
         Note that the actual list of numbers is not stored.
         """
         return self.count
+
+
+class LRUCache:
+    """
+    Dictionary-like cache which keeps only the `maxsize` most recently used items.
+
+    Count hits and misses of `get` calls.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return 'LRU[{}/{}]'.format(len(self.data), self.maxsize)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def get(self, key, default=None):
+        """
+        Return the value of `key` (marking it as the most recently used),
+        or `default` if missing.
+        """
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def clear(self):
+        self.data.clear()
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class FenwickTree:
+    """
+    Binary indexed tree of non negative weights, to draw indices
+    with probability proportional to their weight.
+
+    Both `add` (change a weight) and `find` (draw) are O(log n).
+    """
+    def __init__(self, weights):
+        n = len(weights)
+        self.tree = [0.0] + [float(weight) for weight in weights]
+        # Build in O(n), adding each node to its parent
+        for i in range(1, n + 1):
+            parent = i + (i & -i)
+            if parent <= n:
+                self.tree[parent] += self.tree[i]
+        self.total = sum(weights)
+        self.mask = 1 << n.bit_length() if n else 0
+
+    def __repr__(self):
+        return 'FenwickTree[{}]({})'.format(len(self), self.total)
+
+    def __len__(self):
+        return len(self.tree) - 1
+
+    def add(self, index, delta):
+        """
+        Add `delta` to the weight of `index`.
+        """
+        self.total += delta
+        i = index + 1
+        n = len(self.tree)
+        while i < n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, index):
+        """
+        Return the sum of the weights before `index`.
+        """
+        rv = 0.0
+        i = index
+        while i > 0:
+            rv += self.tree[i]
+            i -= i & -i
+        return rv
+
+    def find(self, value):
+        """
+        Return the index where the cumulative weight exceeds `value`
+        (0 <= value < total), as `bisect` on the cumulative weights.
+        """
+        index = 0
+        n = len(self.tree)
+        step = self.mask
+        while step:
+            next_index = index + step
+            if next_index < n and self.tree[next_index] <= value:
+                index = next_index
+                value -= self.tree[next_index]
+            step >>= 1
+        return min(index, n - 2)
@@ -0,0 +1,89 @@
+"""
+Persistent worker processes with resident islands.
+
+Each worker keeps its islands for the whole session: at every generation
+it only receives a "run" message and sends back the compact results of
+the runs (see `Island.run_summary`), instead of pickling whole islands
+(encoder, evaluator, phenotypes, ...) back and forth.
+"""
+import time
+from multiprocessing import Pipe, Process
+
+RUN = 'run'
+STOP = None
+
+
+def island_worker(connection, islands):
+    """
+    Run the resident `islands` at each RUN message, sending back their summaries,
+    until the STOP message.
+    """
+    while True:
+        message = connection.recv()
+        if message is STOP:
+            break
+        summaries = []
+        for isla in islands:
+            isla.run()
+            summaries.append(isla.run_summary())
+        connection.send(summaries)
+    connection.close()
+
+
+class IslandWorkers:
+    """
+    Pool of `processes` long-lived workers, each one with its share of `islands`.
+
+    The `islands` passed are left as copies in the main process, updated
+    by `run` with the results of the runs of the resident ones.
+    """
+    def __init__(self, islands, processes):
+        self.connections = []
+        self.processes = []
+        processes = min(processes, len(islands))
+        for i in range(processes):
+            connection, worker_connection = Pipe()
+            process = Process(target=island_worker, args=(worker_connection, islands[i::processes]), daemon=True)
+            process.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def __repr__(self):
+        return 'IslandWorkers({})'.format(len(self.processes))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def run(self, islands):
+        """
+        Run all the resident islands at once, and update their copies `islands`.
+
+        Return `islands` and the elapsed time, as `monnalisa.parallelislands`.
+        """
+        i_t0 = time.time()
+        for connection in self.connections:
+            connection.send(RUN)
+        by_index = {isla.index: isla for isla in islands}
+        for connection in self.connections:
+            for summary in connection.recv():
+                by_index[summary['index']].apply_run_summary(summary)
+        i_elapsed = time.time() - i_t0
+        iterations = sum([isla.run_iterations for isla in islands])
+        print('Islands run_speed: {:.3f} it/s'.format(iterations / i_elapsed))
+        return islands, i_elapsed
+
+    def close(self):
+        for connection in self.connections:
+            try:
+                connection.send(STOP)
+            except OSError:
+                pass  # worker already gone (e.g. interrupted)
+            connection.close()
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []